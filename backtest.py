@@ -0,0 +1,135 @@
+import argparse
+import csv
+import json
+import time
+from datetime import datetime
+
+import bot
+
+# ========== BACKTEST ==========
+# Replays recorded prices through the same evaluation code as the live
+# check_prices tick, against a snapshot of the alert file. Nothing is sent
+# and nothing is saved.
+#
+#   python backtest.py ticks.csv [--alerts prices.json] [--output hits.jsonl]
+#
+# CSV input needs the columns timestamp, coin, price and optionally
+# currency (default usd); rows sharing a timestamp form one tick. JSONL
+# input accepts the same rows, or one tick per line as
+# {"timestamp": ..., "prices": {"bitcoin": {"usd": 100000}}}.
+# Coins may be given as symbols (btc) or CoinGecko ids (bitcoin).
+# Timestamps are unix seconds or ISO 8601 and are used as "now" when
+# checking alert expiry.
+
+class NullNotifier:
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, chat_id, text):
+        self.sent += 1
+
+def resolve_coin(value):
+    value = str(value).strip().lower()
+    return bot.SYMBOL_MAP.get(value, value)
+
+def tick_time(timestamp):
+    if timestamp in (None, ""):
+        return None
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(str(timestamp)).timestamp()
+
+def iter_rows(path):
+    with open(path, 'r', newline='') as f:
+        if path.lower().endswith(".csv"):
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def load_ticks(path):
+    ticks = []
+    current_ts, current = None, None
+    for row in iter_rows(path):
+        timestamp = row.get("timestamp")
+        if "prices" in row:
+            prices = {resolve_coin(coin): {cur.lower(): float(p) for cur, p in quoted.items()} for coin, quoted in row["prices"].items()}
+            ticks.append((timestamp, prices))
+            current_ts, current = None, None
+            continue
+        if current is None or timestamp != current_ts:
+            current_ts, current = timestamp, {}
+            ticks.append((timestamp, current))
+        currency = str(row.get("currency") or "usd").strip().lower()
+        current.setdefault(resolve_coin(row["coin"]), {})[currency] = float(row["price"])
+    return ticks
+
+def run_backtest(alerts, ticks):
+    notifier = NullNotifier()
+    bot.assign_alert_ids(alerts)
+    index = bot.AlertIndex(alerts)
+    hits = []
+    evaluated = 0
+
+    start = time.perf_counter()
+    for timestamp, prices in ticks:
+        evaluated += index.size
+        now = tick_time(timestamp)
+        triggered = bot.evaluate_alerts(index, prices, now)
+        if not triggered:
+            continue
+        for user_id, i, alert, current in triggered:
+            notifier.send_message(int(user_id), bot.alert_message(alert, current))
+            hits.append({
+                "timestamp": timestamp,
+                "user_id": user_id,
+                "alert": bot.describe_alert(alert, now),
+                "price": current
+            })
+        bot.remove_alerts_by_id(alerts, {hit[2]["id"] for hit in triggered})
+        # Rebuild like the live tick does after a save
+        index = bot.AlertIndex(alerts)
+    elapsed = time.perf_counter() - start
+
+    return hits, evaluated, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded prices through the alert engine.")
+    parser.add_argument("ticks", help="recorded prices (.csv or .jsonl)")
+    parser.add_argument("--alerts", default=bot.ALERT_FILE, help="alert snapshot to replay against")
+    parser.add_argument("--output", help="write triggered alerts to this JSONL file")
+    parser.add_argument("--show", type=int, default=20, help="number of triggered alerts to print")
+    args = parser.parse_args()
+
+    with open(args.alerts, 'r') as f:
+        alerts = json.load(f)
+    total_alerts = sum(len(user_alerts) for user_alerts in alerts.values())
+
+    load_start = time.perf_counter()
+    ticks = load_ticks(args.ticks)
+    load_elapsed = time.perf_counter() - load_start
+
+    hits, evaluated, elapsed = run_backtest(alerts, ticks)
+
+    for hit in hits[:args.show]:
+        print(f"🚨 {hit['timestamp']} user {hit['user_id']}: {hit['alert']} (price {hit['price']})")
+    if len(hits) > args.show:
+        print(f"... and {len(hits) - args.show} more")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            for hit in hits:
+                f.write(json.dumps(hit) + "\n")
+
+    elapsed = max(elapsed, 1e-9)
+    print(f"\n📊 Alerts in snapshot: {total_alerts}")
+    print(f"📊 Ticks replayed: {len(ticks)} (loaded in {load_elapsed:.2f}s)")
+    print(f"📊 Alerts triggered: {len(hits)}")
+    print(f"⚡ {len(ticks) / elapsed:,.0f} ticks/s, {evaluated / elapsed:,.0f} alerts evaluated/s ({elapsed:.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
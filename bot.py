@@ -1,17 +1,41 @@
+import bisect
+import copy
+import csv
+import email.utils
+import functools
+import hmac
+import html
+import io
 import json
 import os
+import random
+import re
+import time
+import tracemalloc
+import types
+import uuid
 import requests
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from requests.exceptions import Timeout, RequestException
 import asyncio
 import psutil
 import signal
+import sys
+import threading
+import traceback
 from telegram import Update
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import ContextTypes
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from threading import Thread
+from urllib.parse import parse_qs, urlparse
+from collections import deque
+from contextlib import contextmanager
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
+    CallbackContext,
     CommandHandler,
     ContextTypes,
     MessageHandler,
@@ -26,14 +50,245 @@ load_dotenv()
 ALERT_FILE = 'prices.json'
 ACCESS_FILE = 'access.json'
 SYMBOL_MAP_FILE = 'symbols.json'
+OUTBOX_FILE = 'outbox.json'
+RUNTIME_FILE = 'runtime.json'
+COIN_CATALOG_FILE = 'coin_catalog.json'
 
 # Configuration
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 PING_URL = os.getenv("PING_URL", "http://localhost:10001")
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
 OWNER_ID = os.getenv("OWNER_ID", "5817239686")
+SUPPORTED_CURRENCIES = [c.strip().lower() for c in os.getenv("SUPPORTED_CURRENCIES", "usd,eur,gbp,jpy,aud,cad,chf,inr,btc,eth").split(",") if c.strip()]
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+
+# ========== FIRESTORE STORE ==========
+# Optional backend (STORAGE_BACKEND=firestore) for alerts, access,
+# symbols, the notification outbox and the runtime snapshot, so nothing
+# the bot needs after a restart lives on the dyno's disk. Everything is read once into a local cache at startup; loads
+# are served from the cache and saves write only the documents that
+# changed, in batched commits, so a tick that removes N triggered alerts
+# costs one batch rather than N writes. The cache is updated at once and
+# the commits run in order on a single writer thread, so a save never
+# blocks the event loop on gRPC. A failed commit is retried, with backoff,
+# until it goes through: the cache already says it happened, and later
+# diffs are taken against the cache. load_alerts(readonly=True) returns a
+# shared view instead of a copy. Set FIRESTORE_EMULATOR_HOST to run
+# against the local emulator.
+#
+#   {prefix}alerts/{alert_id}         alert fields + user_id + seq
+#   {prefix}access_{key}/{doc_id}     one collection per dict in access.json
+#   {prefix}config/access             scalar access fields (owner, ...)
+#   {prefix}config/symbols            {"map": SYMBOL_MAP}
+#   {prefix}outbox/{key}              pending entry + state, or sent_at
+#   {prefix}config/outbox             {"paused_until": ...}
+#   {prefix}config/alerts             marker: alerts live in Firestore, so
+#                                     an empty collection means no alerts
+FIREBASE_CREDENTIALS = os.getenv("FIREBASE_CREDENTIALS")
+FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID")
+FIRESTORE_PREFIX = os.getenv("FIRESTORE_PREFIX", "")
+FIRESTORE_BATCH_SIZE = 500
+FIRESTORE_FLUSH_TIMEOUT = float(os.getenv("FIRESTORE_FLUSH_TIMEOUT", "20"))
+
+class FirestoreStore:
+    def __init__(self):
+        self.db = self._connect()
+        self.alerts = {}
+        # False until alerts exist in Firestore; until then load_alerts
+        # falls back to ALERT_FILE, like access and symbols do
+        self.has_alerts = False
+        self.access_docs = {}
+        self.access_meta = {}
+        self.symbols = None
+        self.outbox = {}
+        self.outbox_paused_until = 0
+        self._alerts_view = None
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="firestore")
+        self._load_cache()
+
+    def _connect(self):
+        if os.getenv("FIRESTORE_EMULATOR_HOST"):
+            from google.auth.credentials import AnonymousCredentials
+            from google.cloud import firestore as gcloud_firestore
+            return gcloud_firestore.Client(project=FIREBASE_PROJECT_ID or "demo-pro-bot-alert", credentials=AnonymousCredentials())
+
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(FIREBASE_CREDENTIALS) if FIREBASE_CREDENTIALS else credentials.ApplicationDefault()
+            options = {"projectId": FIREBASE_PROJECT_ID} if FIREBASE_PROJECT_ID else None
+            firebase_admin.initialize_app(cred, options)
+        return firestore.client()
+
+    def _collection(self, name):
+        return self.db.collection(f"{FIRESTORE_PREFIX}{name}")
+
+    def _load_cache(self):
+        for doc in self._collection("alerts").stream():
+            self.alerts[doc.id] = doc.to_dict()
+        self.has_alerts = bool(self.alerts) or self._collection("config").document("alerts").get().exists
+        meta = self._collection("config").document("access").get()
+        self.access_meta = meta.to_dict() if meta.exists else {}
+        for key in self.access_meta.pop("_collections", ["users", "requests", "coin_requests"]):
+            self.access_docs[key] = {doc.id: doc.to_dict() for doc in self._collection(f"access_{key}").stream()}
+        symbols = self._collection("config").document("symbols").get()
+        self.symbols = symbols.to_dict().get("map") if symbols.exists else None
+        self.outbox = {doc.id: doc.to_dict() for doc in self._collection("outbox").stream()}
+        outbox_meta = self._collection("config").document("outbox").get()
+        self.outbox_paused_until = outbox_meta.to_dict().get("paused_until", 0) if outbox_meta.exists else 0
+        print(f"✅ Firestore cache loaded ({len(self.alerts)} alerts)")
+        if not self.has_alerts:
+            print(f"ℹ️ No alerts in Firestore yet; reading {ALERT_FILE} until the first save")
+
+    def _commit(self, writes):
+        # writes: [(doc_ref, data or None for delete)]
+        for start in range(0, len(writes), FIRESTORE_BATCH_SIZE):
+            batch = self.db.batch()
+            for ref, data in writes[start:start + FIRESTORE_BATCH_SIZE]:
+                if data is None:
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, data)
+            batch.commit()
+
+    def _write(self, writes):
+        # Runs on the writer thread; retrying here keeps later writes queued
+        # behind this one, so documents never go back to an older state
+        attempt = 0
+        while True:
+            try:
+                self._commit(writes)
+                if attempt:
+                    print(f"✅ Firestore write of {len(writes)} document(s) went through after {attempt} retries")
+                return
+            except Exception as e:
+                attempt += 1
+                print(f"⚠️ Firestore write of {len(writes)} document(s) failed (attempt {attempt}), retrying: {e}")
+                time.sleep(backoff_delay(attempt))
+
+    def submit(self, writes):
+        if writes:
+            self.writer.submit(self._write, writes)
+
+    def flush(self, timeout=FIRESTORE_FLUSH_TIMEOUT):
+        # Waits for every queued write to commit; False if Firestore is
+        # still failing when the timeout runs out
+        try:
+            self.writer.submit(lambda: None).result(timeout)
+            return True
+        except FutureTimeout:
+            print(f"⚠️ Firestore writes still pending after {timeout:g}s")
+            return False
+
+    def _diff(self, collection, cached, docs):
+        writes = []
+        ref = self._collection(collection)
+        for doc_id, data in docs.items():
+            if cached.get(doc_id) != data:
+                writes.append((ref.document(doc_id), data))
+        for doc_id in cached.keys() - docs.keys():
+            writes.append((ref.document(doc_id), None))
+        return writes
+
+    # ----- alerts -----
+    def load_alerts(self, readonly=False):
+        if self._alerts_view is None:
+            alerts = {}
+            for doc in sorted(self.alerts.values(), key=lambda d: (d["user_id"], d["seq"])):
+                alert = {k: v for k, v in doc.items() if k not in ("user_id", "seq")}
+                alerts.setdefault(doc["user_id"], []).append(alert)
+            self._alerts_view = alerts
+        return self._alerts_view if readonly else copy.deepcopy(self._alerts_view)
+
+    def save_alerts(self, alerts):
+        assign_alert_ids(alerts)
+        docs = {}
+        for user_id, user_alerts in alerts.items():
+            # Keep existing seq numbers where they still sort correctly so
+            # removing one alert doesn't rewrite every later one
+            previous = -1
+            for alert in user_alerts:
+                cached = self.alerts.get(alert["id"])
+                seq = cached["seq"] if cached and cached.get("user_id") == user_id and cached["seq"] > previous else previous + 1
+                docs[alert["id"]] = {**copy.deepcopy(alert), "user_id": user_id, "seq": seq}
+                previous = seq
+        writes = self._diff("alerts", self.alerts, docs)
+        if not self.has_alerts:
+            writes.append((self._collection("config").document("alerts"), {"initialized": True}))
+        self.submit(writes)
+        self.alerts = docs
+        self.has_alerts = True
+        self._alerts_view = None
+
+    # ----- access -----
+    def load_access(self):
+        if not self.access_meta and not self.access_docs.get("users"):
+            return None
+        access = copy.deepcopy(self.access_meta)
+        for key, docs in self.access_docs.items():
+            access[key] = copy.deepcopy(docs)
+        return access
+
+    def save_access(self, access):
+        writes = []
+        meta = {k: v for k, v in access.items() if not isinstance(v, dict)}
+        collections = sorted(k for k, v in access.items() if isinstance(v, dict))
+        new_docs = {}
+        for key in collections:
+            new_docs[key] = copy.deepcopy(access[key])
+            writes += self._diff(f"access_{key}", self.access_docs.get(key, {}), new_docs[key])
+        if meta != self.access_meta or collections != sorted(self.access_docs):
+            writes.append((self._collection("config").document("access"), {**meta, "_collections": collections}))
+        self.submit(writes)
+        self.access_meta = copy.deepcopy(meta)
+        self.access_docs = new_docs
+
+    # ----- symbols -----
+    def load_symbol_map(self):
+        return dict(self.symbols) if self.symbols is not None else None
+
+    def save_symbol_map(self, symbol_map):
+        self.symbols = dict(symbol_map)
+        self.submit([(self._collection("config").document("symbols"), {"map": self.symbols})])
+
+    # ----- outbox -----
+    def load_outbox(self):
+        if not self.outbox and not self.outbox_paused_until:
+            return None
+        data = {"pending": {}, "sent": {}, "paused_until": self.outbox_paused_until}
+        for key, doc in self.outbox.items():
+            if doc.get("state") == "sent":
+                data["sent"][key] = doc["sent_at"]
+            else:
+                data["pending"][key] = {k: v for k, v in doc.items() if k != "state"}
+        return data
+
+    def save_outbox(self, data):
+        # Entries are flat dicts of scalars, so a shallow copy is a snapshot
+        docs = {key: {**entry, "state": "pending"} for key, entry in data["pending"].items()}
+        docs.update({key: {"state": "sent", "sent_at": sent_at} for key, sent_at in data["sent"].items()})
+        writes = self._diff("outbox", self.outbox, docs)
+        paused_until = data.get("paused_until", 0)
+        if paused_until != self.outbox_paused_until:
+            writes.append((self._collection("config").document("outbox"), {"paused_until": paused_until}))
+        self.submit(writes)
+        self.outbox = docs
+        self.outbox_paused_until = paused_until
+
+    # ----- runtime snapshot (not cached: read once at startup) -----
+    def load_runtime(self):
+        doc = self._collection("config").document("runtime").get()
+        return doc.to_dict() if doc.exists else None
+
+    def save_runtime(self, data):
+        self.submit([(self._collection("config").document("runtime"), data)])
+
+STORE = FirestoreStore() if STORAGE_BACKEND == "firestore" else None
 
 # Crypto symbol mapping
 def load_symbol_map():
+    if STORE is not None and STORE.load_symbol_map() is not None:
+        return STORE.load_symbol_map()
     try:
         if os.path.exists(SYMBOL_MAP_FILE):
             with open(SYMBOL_MAP_FILE, 'r') as f:
@@ -56,6 +311,12 @@ def load_symbol_map():
     }
 
 def save_symbol_map(data):
+    if STORE is not None:
+        try:
+            STORE.save_symbol_map(data)
+        except Exception as e:
+            print(f"Error saving symbol map: {e}")
+        return
     try:
         with open(SYMBOL_MAP_FILE, 'w') as f:
             json.dump(data, f, indent=2)
@@ -68,6 +329,7 @@ SYMBOL_MAP = load_symbol_map()
 # ========== INSTANCE MANAGEMENT ==========
 def kill_previous_instances():
     current_pid = os.getpid()
+    killed = []
     for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
         try:
             if ('python' in proc.info['name'].lower() or 
@@ -78,10 +340,14 @@ def kill_previous_instances():
                         print(f"⚠️ Killing previous instance (PID: {proc.info['pid']})")
                         try:
                             os.kill(proc.info['pid'], signal.SIGTERM)
+                            killed.append(proc)
                         except ProcessLookupError:
                             pass
         except (psutil.NoSuchProcess, psutil.AccessDenied):
             continue
+    # Let them finish writing their runtime snapshot before we read it
+    if killed:
+        psutil.wait_procs(killed, timeout=15)
 
 def cleanup_ports():
     for port in [10002, 10003]:
@@ -97,7 +363,10 @@ def cleanup_ports():
             print(f"Port cleanup warning: {e}")
 
 # ========== DATA MANAGEMENT ==========
-def load_alerts():
+def load_alerts(readonly=False):
+    # readonly=True may return a shared object; the caller must not modify it
+    if STORE is not None and STORE.has_alerts:
+        return STORE.load_alerts(readonly)
     try:
         if os.path.exists(ALERT_FILE):
             with open(ALERT_FILE, 'r') as f:
@@ -106,42 +375,841 @@ def load_alerts():
         print(f"Error loading alerts: {e}")
     return {}
 
+# Bumped on every save so cached alert indexes know when to rebuild
+ALERTS_VERSION = 0
+
+def write_json_atomic(path, data):
+    # Write to a temp file and rename over the target, so a crash mid-write
+    # never leaves a truncated file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
 def save_alerts(data):
+    global ALERTS_VERSION
+    ALERTS_VERSION += 1
     try:
-        with open(ALERT_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
+        if STORE is not None:
+            STORE.save_alerts(data)
+            return
+        write_json_atomic(ALERT_FILE, data)
     except Exception as e:
         print(f"Error saving alerts: {e}")
 
+def assign_alert_ids(alerts):
+    # Alert ids double as notification idempotency keys
+    assigned = 0
+    for user_alerts in alerts.values():
+        for alert in user_alerts:
+            if "id" not in alert:
+                alert["id"] = uuid.uuid4().hex
+                assigned += 1
+    return assigned
+
+def alerts_version():
+    if STORE is not None and STORE.has_alerts:
+        return (ALERTS_VERSION,)
+    try:
+        st = os.stat(ALERT_FILE)
+        return (ALERTS_VERSION, st.st_mtime_ns, st.st_size)
+    except OSError:
+        return (ALERTS_VERSION, None, None)
+
+def load_outbox():
+    if STORE is not None:
+        data = STORE.load_outbox()
+        if data is not None:
+            return data
+    try:
+        if os.path.exists(OUTBOX_FILE):
+            with open(OUTBOX_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"Error loading outbox: {e}")
+    return {"pending": {}, "sent": {}}
+
+def save_outbox(data):
+    try:
+        if STORE is not None:
+            STORE.save_outbox(data)
+            return
+        write_json_atomic(OUTBOX_FILE, data)
+    except Exception as e:
+        print(f"Error saving outbox: {e}")
+
 def load_access():
+    if STORE is not None:
+        access = STORE.load_access()
+        if access is not None:
+            return index_pending_requests(access)
     try:
         if os.path.exists(ACCESS_FILE):
             with open(ACCESS_FILE, 'r') as f:
-                return json.load(f)
+                return index_pending_requests(json.load(f))
     except Exception as e:
         print(f"Error loading access: {e}")
     return {
         "owner": OWNER_ID,
         "users": {},
-        "requests": [],
-        "coin_requests": []
+        "requests": {},
+        "coin_requests": {},
+        "channels": {}
     }
 
+# Pending requests are keyed by user ("requests") and by "user_id:coin"
+# ("coin_requests") so lookups and dedupe don't scan. Older files stored
+# them as lists; those are converted on load.
+PENDING_REQUEST_TTL = float(os.getenv("PENDING_REQUEST_TTL", str(7 * 24 * 3600)))
+
+def coin_request_key(user_id, coin):
+    return f"{user_id}:{coin}"
+
+def index_pending_requests(access):
+    requests_ = access.get("requests", {})
+    if isinstance(requests_, list):
+        requests_ = {req["user_id"]: req for req in requests_}
+    coin_requests = access.get("coin_requests", {})
+    if isinstance(coin_requests, list):
+        coin_requests = {coin_request_key(req["user_id"], req["coin"]): req for req in coin_requests}
+    access["requests"] = requests_
+    access["coin_requests"] = coin_requests
+    return access
+
+def is_request_expired(req, now=None):
+    requested_at = req.get("requested_at")
+    if requested_at is None:
+        return False
+    return (now or time.time()) - requested_at > PENDING_REQUEST_TTL
+
+def get_pending_request(access, key, coin=None):
+    pending = access["coin_requests"] if coin else access["requests"]
+    req = pending.get(coin_request_key(key, coin) if coin else key)
+    if req is None or is_request_expired(req):
+        return None
+    return req
+
+def expire_pending_requests(access, now=None):
+    # Returns (expired, stamped); requests from older files get their TTL
+    # clock started here
+    now = now or time.time()
+    expired = stamped = 0
+    for pending in (access["requests"], access["coin_requests"]):
+        for key, req in list(pending.items()):
+            if "requested_at" not in req:
+                req["requested_at"] = now
+                stamped += 1
+            elif is_request_expired(req, now):
+                del pending[key]
+                expired += 1
+    return expired, stamped
+
 def save_access(data):
+    if STORE is not None:
+        try:
+            STORE.save_access(data)
+        except Exception as e:
+            print(f"Error saving access: {e}")
+        return
     try:
-        with open(ACCESS_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
+        # Atomic: handlers read access.json without the lock, and a bulk
+        # import saves it from a worker thread
+        write_json_atomic(ACCESS_FILE, data)
     except Exception as e:
         print(f"Error saving access: {e}")
 
+# Updates are handled concurrently (see UserOrderedUpdateProcessor), so
+# every load -> modify -> save of a store happens under its lock, loading
+# inside the lock. Take ACCESS_LOCK before ALERTS_LOCK when both are needed.
+ACCESS_LOCK = asyncio.Lock()
+ALERTS_LOCK = asyncio.Lock()
+
+# ========== INSTRUMENTATION ==========
+# Rolling per-handler latency samples. Recording is two perf_counter calls
+# and a deque append; percentiles are only computed when /stats asks.
+STATS_WINDOW = int(os.getenv("STATS_WINDOW", "1000"))
+
+# Handlers and tick phases currently in flight, read by the loop watchdog
+ACTIVE_CALLBACKS = {}
+
+class HandlerStats:
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.calls = {}
+        self.errors = {}
+
+    def record(self, name, duration, failed=False):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.window)
+        samples.append(duration)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if failed:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def percentiles(self, name, points=(50, 95, 99)):
+        ordered = sorted(self.samples.get(name, ()))
+        if not ordered:
+            return [None for _ in points]
+        return [ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points]
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        token = object()
+        ACTIVE_CALLBACKS[token] = (name, start)
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            ACTIVE_CALLBACKS.pop(token, None)
+            self.record(name, time.perf_counter() - start, failed)
+
+    def summary(self):
+        rows = []
+        for name in sorted(self.samples):
+            p50, p95, p99 = self.percentiles(name)
+            rows.append((name, self.calls.get(name, 0), self.errors.get(name, 0), p50, p95, p99))
+        return rows
+
+STATS = HandlerStats()
+
+def timed(name, handler):
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        token = object()
+        ACTIVE_CALLBACKS[token] = (name, start)
+        failed = False
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            ACTIVE_CALLBACKS.pop(token, None)
+            STATS.record(name, time.perf_counter() - start, failed)
+    return wrapper
+
+def active_callback_names():
+    # list() snapshots the values first; the watchdog calls this from its own
+    # thread while the loop may be adding or removing entries
+    return [name for name, _ in sorted(list(ACTIVE_CALLBACKS.values()), key=lambda item: item[1])]
+
+# ========== EVENT LOOP MONITOR ==========
+# A coroutine wakes up every LAG_INTERVAL seconds and records how late it
+# was ("loop.lag" in /stats). A watchdog thread watches the same heartbeat;
+# when the loop has been stuck for longer than LAG_THRESHOLD it grabs the
+# loop thread's stack, so the blocking call shows up in the log.
+LAG_INTERVAL = float(os.getenv("LAG_INTERVAL", "0.5"))
+LAG_THRESHOLD = float(os.getenv("LAG_THRESHOLD", "0.25"))
+
+class LoopMonitor:
+    def __init__(self, interval=LAG_INTERVAL, threshold=LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.stalls = deque(maxlen=20)
+        self._reported_beat = None
+
+    async def run(self):
+        self.loop_thread_id = threading.get_ident()
+        Thread(target=self._watchdog, daemon=True).start()
+        while True:
+            expected = time.monotonic() + self.interval
+            self.heartbeat = expected
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - expected)
+            STATS.record("loop.lag", lag)
+            if lag > self.threshold:
+                print(f"🐢 Event loop lagged {lag * 1000:.0f} ms (running: {', '.join(active_callback_names()) or 'unknown'})")
+
+    def _watchdog(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            try:
+                self._check_stall()
+            except Exception as e:
+                print(f"Loop watchdog error: {e}")
+
+    def _check_stall(self):
+        beat = self.heartbeat
+        stalled = time.monotonic() - beat
+        if stalled <= self.threshold or beat == self._reported_beat:
+            return
+        self._reported_beat = beat
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)[-6:]) if frame else ""
+        running = ", ".join(active_callback_names()) or "unknown"
+        self.stalls.append({
+            "at": time.time(),
+            "stalled": stalled,
+            "running": running,
+            "stack": stack
+        })
+        print(f"🐢 Event loop blocked for {stalled * 1000:.0f} ms+ in {running}\n{stack}")
+
+LOOP_MONITOR = LoopMonitor()
+
+# ========== UPSTREAM CLIENT ==========
+# Every CoinGecko call goes through one client: 429/5xx/timeouts are retried
+# with exponential backoff and full jitter (Retry-After wins when present),
+# and repeated failures open a circuit breaker. While the circuit is open,
+# callers get the last known prices flagged as stale instead of a request.
+# A caller with a deadline (the tick's fetch budget) gets each request's
+# timeout and every retry sleep capped by the time left, so the worker
+# thread gives up when the caller does instead of retrying in the
+# background.
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "10"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "10"))
+PRICE_BATCH_SIZE = int(os.getenv("PRICE_BATCH_SIZE", "250"))
+UPSTREAM_RETRY_BUDGET = float(os.getenv("UPSTREAM_RETRY_BUDGET", "20"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "1"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "30"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+BREAKER_COOLDOWN_MAX = float(os.getenv("BREAKER_COOLDOWN_MAX", "300"))
+
+class UpstreamError(Exception):
+    pass
+
+class RateLimited(UpstreamError):
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class CircuitOpen(UpstreamError):
+    def __init__(self, retry_in):
+        super().__init__(f"circuit open, retry in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, base=UPSTREAM_BACKOFF_BASE, cap=UPSTREAM_BACKOFF_MAX):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN, cooldown_max=BREAKER_COOLDOWN_MAX):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.cooldown_max = cooldown_max
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.open_until > time.monotonic():
+            return "open"
+        return "half-open" if self.trips else "closed"
+
+    def before_request(self):
+        with self.lock:
+            remaining = self.open_until - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpen(remaining)
+            if self.trips:
+                # Half-open: let a single probe through, fail the rest fast
+                if self.probing:
+                    raise CircuitOpen(0)
+                self.probing = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.trips = 0
+            self.probing = False
+            self.open_until = 0.0
+
+    def record_failure(self, retry_after=None):
+        with self.lock:
+            self.failures += 1
+            tripped = self.probing or self.failures >= self.threshold
+            self.probing = False
+            if retry_after is not None or tripped:
+                cooldown = 0.0
+                if tripped:
+                    cooldown = min(self.cooldown_max, self.cooldown * (2 ** self.trips))
+                    self.trips += 1
+                    self.failures = 0
+                self.open_until = max(self.open_until, time.monotonic() + max(cooldown, retry_after or 0.0))
+
+class UpstreamClient:
+    def __init__(self, base_url=COINGECKO_API_URL):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.breaker = CircuitBreaker()
+        # coin -> currency -> (price, fetched_at)
+        self.last_prices = {}
+        # True after a warm restart until the first refresh finishes
+        self.warming = False
+
+    def _get_json(self, path, params=None, deadline=None):
+        # deadline is a time.monotonic() value
+        retry_deadline = time.monotonic() + UPSTREAM_RETRY_BUDGET
+        if deadline is not None:
+            retry_deadline = min(retry_deadline, deadline)
+        attempt = 0
+        while True:
+            timeout = UPSTREAM_TIMEOUT
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    raise UpstreamError("deadline exceeded")
+            self.breaker.before_request()
+            retry_after = None
+            try:
+                response = self.session.get(f"{self.base_url}{path}", params=params, timeout=timeout)
+                if response.status_code == 429 or response.status_code >= 500:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    error = RateLimited(retry_after or 0) if response.status_code == 429 else UpstreamError(f"HTTP {response.status_code}")
+                else:
+                    response.raise_for_status()
+                    data = response.json()
+                    self.breaker.record_success()
+                    return data
+            except (Timeout, requests.exceptions.ConnectionError) as e:
+                error = e
+            except RequestException:
+                # Other 4xx: the upstream answered, so retrying won't help
+                self.breaker.record_success()
+                raise
+
+            self.breaker.record_failure(retry_after)
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+            attempt += 1
+            if time.monotonic() + delay > retry_deadline:
+                raise error
+            time.sleep(delay)
+
+    async def get_json(self, path, params=None, deadline=None):
+        return await asyncio.to_thread(self._get_json, path, params, deadline)
+
+    async def fetch_prices(self, coin_ids, currencies=("usd",), deadline=None):
+        # Returns ({coin: {currency: price}}, {coin: fetched_at} for stale coins).
+        # All currencies ride along in one request per chunk of coin ids;
+        # chunks not fetched by the deadline are served from the cache.
+        coin_ids = sorted(set(coin_ids))
+        currencies = sorted(set(currencies))
+        prices, stale = {}, {}
+        error = None
+        for start in range(0, len(coin_ids), PRICE_BATCH_SIZE):
+            chunk = coin_ids[start:start + PRICE_BATCH_SIZE]
+            try:
+                data = await self.get_json("/simple/price", {"ids": ",".join(chunk), "vs_currencies": ",".join(currencies)}, deadline)
+            except (UpstreamError, RequestException) as e:
+                error = e
+                cached, cached_stale = self.cached_prices(chunk, currencies)
+                prices.update(cached)
+                stale.update(cached_stale)
+                continue
+
+            now = time.time()
+            for coin in chunk:
+                quoted = {cur: price for cur, price in (data.get(coin) or {}).items() if cur in currencies and price is not None}
+                if not quoted:
+                    continue
+                prices[coin] = quoted
+                cache = self.last_prices.setdefault(coin, {})
+                for cur, price in quoted.items():
+                    cache[cur] = (price, now)
+
+        if error is not None:
+            if not prices:
+                raise error
+            print(f"⚠️ Serving stale prices ({error})")
+        return prices, stale
+
+    async def recent_prices(self, coin_ids, currencies=("usd",), max_age=PRICE_CACHE_TTL):
+        # Answers from the cache when every quote is at most max_age old.
+        # While warming up, restored quotes of any age are served at once
+        # and reported stale so the caller shows their age.
+        cached, fetched_at = self.cached_prices(coin_ids, currencies)
+        complete = len(cached) == len(set(coin_ids)) and all(len(quoted) == len(set(currencies)) for quoted in cached.values())
+        if complete:
+            now = time.time()
+            old = {coin: ts for coin, ts in fetched_at.items() if now - ts > max_age}
+            if self.warming or not old:
+                return cached, old
+        return await self.fetch_prices(coin_ids, currencies)
+
+    def restore(self, last_prices):
+        for coin, quoted in last_prices.items():
+            cache = self.last_prices.setdefault(coin, {})
+            for cur, (price, fetched_at) in quoted.items():
+                if cur not in cache or cache[cur][1] < fetched_at:
+                    cache[cur] = (price, fetched_at)
+
+    def cached_prices(self, coin_ids, currencies=("usd",)):
+        prices, stale = {}, {}
+        for coin in coin_ids:
+            cache = self.last_prices.get(coin, {})
+            quoted = {cur: cache[cur] for cur in currencies if cur in cache}
+            if quoted:
+                prices[coin] = {cur: price for cur, (price, _) in quoted.items()}
+                stale[coin] = min(fetched_at for _, fetched_at in quoted.values())
+        return prices, stale
+
+UPSTREAM = UpstreamClient()
+
+def format_duration(seconds):
+    seconds = max(0, int(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m"
+    if seconds < 2 * 86400:
+        return f"{seconds // 3600}h"
+    return f"{seconds // 86400}d"
+
+def format_age(timestamp):
+    return format_duration(time.time() - timestamp)
+
+# ========== SYMBOL INDEX ==========
+# Resolves what users type to coins: exact and prefix matches come from a
+# sorted term list (bisect, so no per-character node objects for the
+# ~15k-coin CoinGecko catalog), typos from a SymSpell-style table of
+# character deletions. Tracked coins (symbols.json) always rank first.
+# Catalog symbols, ids and names come from coin_catalog.json, a cached
+# copy of /coins/list; names are prefix-matched only.
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", str(24 * 3600)))
+SUGGEST_MAX_DISTANCE = 2
+
+def suggest_distance(query):
+    # One typo in short symbols already reaches most other short symbols
+    return 1 if len(query) <= 4 else SUGGEST_MAX_DISTANCE
+
+def edit_distance(a, b, limit):
+    # Optimal string alignment distance, giving up once it exceeds limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_min = current[0]
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if previous2 is not None and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+            row_min = min(row_min, current[j])
+        if row_min > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+def delete_variants(term, depth):
+    variants = {term}
+    frontier = {term}
+    for _ in range(depth):
+        frontier = {word[:i] + word[i + 1:] for word in frontier for i in range(len(word)) if len(word) > 1}
+        variants |= frontier
+    return variants
+
+class SymbolIndex:
+    def __init__(self, symbol_map, catalog=()):
+        self.terms = []
+        self.entries = {}
+        self.deletes = {}
+        self.tracked = {}
+        for coin in catalog:
+            coin_id = coin.get("id")
+            if not coin_id:
+                continue
+            for term, fuzzy in ((coin.get("symbol"), True), (coin_id, True), (coin.get("name"), False)):
+                if not term:
+                    continue
+                term = term.lower()
+                if term not in self.entries:
+                    self.entries[term] = set()
+                    if fuzzy:
+                        self._index_deletes(term, 1)
+                self.entries[term].add(coin_id)
+        self.terms = sorted(self.entries)
+        for symbol, coin_id in symbol_map.items():
+            self.add_tracked(symbol, coin_id)
+
+    def _index_deletes(self, term, depth):
+        # Values stay plain strings until two terms share a variant
+        for variant in delete_variants(term, depth):
+            existing = self.deletes.get(variant)
+            if existing is None:
+                self.deletes[variant] = term
+            elif isinstance(existing, str):
+                if existing != term:
+                    self.deletes[variant] = [existing, term]
+            elif term not in existing:
+                existing.append(term)
+
+    def _add_term(self, term, coin_id, depth):
+        if term not in self.entries:
+            bisect.insort(self.terms, term)
+            self.entries[term] = set()
+        self.entries[term].add(coin_id)
+        self._index_deletes(term, depth)
+
+    def _terms_for(self, variant):
+        terms = self.deletes.get(variant, ())
+        return (terms,) if isinstance(terms, str) else terms
+
+    def add_tracked(self, symbol, coin_id):
+        # Incremental: called for every symbols.json entry and by /new_coin
+        self.tracked[coin_id] = symbol
+        self._add_term(symbol, coin_id, SUGGEST_MAX_DISTANCE)
+        self._add_term(coin_id, coin_id, 1)
+
+    def complete(self, prefix, limit=20):
+        start = bisect.bisect_left(self.terms, prefix)
+        matches = []
+        for term in self.terms[start:start + limit]:
+            if not term.startswith(prefix):
+                break
+            matches.append(term)
+        return matches
+
+    def suggest(self, query, limit=5, tracked_only=False):
+        # Returns [(coin_id, tracked_symbol_or_None)] best first
+        query = query.strip().lower()
+        if not query:
+            return []
+        scored = {}
+
+        def consider(term, tier, distance):
+            for coin_id in self.entries.get(term, ()):
+                symbol = self.tracked.get(coin_id)
+                if tracked_only and symbol is None:
+                    continue
+                score = (symbol is None, tier, distance, len(term))
+                if coin_id not in scored or score < scored[coin_id]:
+                    scored[coin_id] = score
+
+        consider(query, 0, 0)
+        for term in self.complete(query):
+            consider(term, 1, len(term) - len(query))
+        max_distance = suggest_distance(query)
+        seen = set()
+        for variant in delete_variants(query, max_distance):
+            for term in self._terms_for(variant):
+                if term in seen:
+                    continue
+                seen.add(term)
+                if tracked_only and not any(coin_id in self.tracked for coin_id in self.entries[term]):
+                    continue
+                distance = edit_distance(query, term, max_distance)
+                if distance <= max_distance:
+                    consider(term, 2, distance)
+
+        ranked = sorted(scored, key=lambda coin_id: scored[coin_id])
+        return [(coin_id, self.tracked.get(coin_id)) for coin_id in ranked[:limit]]
+
+def load_coin_catalog():
+    try:
+        if os.path.exists(COIN_CATALOG_FILE):
+            with open(COIN_CATALOG_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"Error loading coin catalog: {e}")
+    return {"fetched_at": 0, "coins": []}
+
+SYMBOL_INDEX = SymbolIndex(SYMBOL_MAP, load_coin_catalog()["coins"])
+
+async def get_coin_catalog(force=False):
+    # Cached /coins/list; refreshed when older than CATALOG_TTL or forced
+    global SYMBOL_INDEX
+    catalog = load_coin_catalog()
+    if not force and time.time() - catalog["fetched_at"] < CATALOG_TTL:
+        return catalog["coins"]
+    coins = await UPSTREAM.get_json("/coins/list")
+    catalog = {"fetched_at": time.time(), "coins": coins}
+    await asyncio.to_thread(write_json_atomic, COIN_CATALOG_FILE, catalog)
+    SYMBOL_INDEX = await asyncio.to_thread(SymbolIndex, SYMBOL_MAP, coins)
+    return coins
+
+async def refresh_coin_catalog():
+    try:
+        await get_coin_catalog()
+    except Exception as e:
+        print(f"Coin catalog refresh failed: {e}")
+
+def format_suggestions(suggestions):
+    return ", ".join(symbol.upper() if symbol else coin_id for coin_id, symbol in suggestions)
+
+
+# ========== MEMORY PROFILING ==========
+# tracemalloc is off by default (it costs memory and CPU on every
+# allocation). The owner turns it on with /mem start, marks a baseline with
+# /mem snapshot and later sees what grew with /mem diff. The same report is
+# served on the ping server at /mem?token=MEM_TOKEN&action=... when
+# MEM_TOKEN is set.
+MEM_TOKEN = os.getenv("MEM_TOKEN")
+MEM_FRAMES = int(os.getenv("MEM_FRAMES", "1"))
+MEM_TOP = 15
+MEM_ACTIONS = ("status", "start", "stop", "top", "snapshot", "diff", "sizes")
+
+def deep_sizeof(obj):
+    # Rough retained size: follows containers and instance __dict__s,
+    # counting each object once
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(o)
+        elif hasattr(o, "__dict__"):
+            stack.append(vars(o))
+    return size
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def memory_structures():
+    alerts = load_alerts(readonly=True)
+    access = load_access()
+    structures = [
+        (f"alerts ({sum(len(a) for a in alerts.values())})", alerts),
+        (f"access ({len(access['users'])} users)", access),
+        ("alert index", _ALERT_INDEX_CACHE["index"]),
+        ("symbol index", SYMBOL_INDEX),
+        ("symbol map", SYMBOL_MAP),
+        ("last prices", UPSTREAM.last_prices),
+        ("upstream session", UPSTREAM.session),
+        (f"outbox ({len(OUTBOX.pending)} pending)", (OUTBOX.pending, OUTBOX.sent)),
+        ("handler stats", STATS.samples),
+        ("owner digest", OWNER_DIGEST),
+        ("loop stalls", LOOP_MONITOR.stalls),
+    ]
+    if STORE is not None:
+        structures.append(("firestore cache", (STORE.alerts, STORE.access_docs, STORE.access_meta, STORE.symbols, STORE.outbox)))
+    return [(name, deep_sizeof(obj)) for name, obj in structures]
+
+class MemoryProfiler:
+    def __init__(self):
+        self.baseline = None
+        self.loop = None
+
+    @staticmethod
+    def take_snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    def status(self):
+        lines = [f"RSS: {format_bytes(psutil.Process().memory_info().rss)}"]
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"tracemalloc: on ({tracemalloc.get_traceback_limit()} frame(s)), traced {format_bytes(current)}, peak {format_bytes(peak)}")
+            lines.append(f"tracemalloc overhead: {format_bytes(tracemalloc.get_tracemalloc_memory())}")
+        else:
+            lines.append("tracemalloc: off")
+        lines.append(f"baseline snapshot: {'yes' if self.baseline else 'no'}")
+        return lines
+
+    def report(self, action="status", arg=None):
+        if action not in MEM_ACTIONS:
+            return [f"Unknown action. Use one of: {', '.join(MEM_ACTIONS)}"]
+        if action == "sizes":
+            rows = sorted(memory_structures(), key=lambda row: row[1], reverse=True)
+            return [f"{name[:28]:<28}{format_bytes(size):>12}" for name, size in rows]
+        if action == "start":
+            if tracemalloc.is_tracing():
+                return ["tracemalloc is already running."]
+            tracemalloc.start(int(arg) if arg else MEM_FRAMES)
+            self.baseline = None
+            return ["tracemalloc started."] + self.status()
+        if action == "stop":
+            tracemalloc.stop()
+            self.baseline = None
+            return ["tracemalloc stopped."] + self.status()
+        if action in ("top", "snapshot", "diff") and not tracemalloc.is_tracing():
+            return ["tracemalloc is off. Start it first with action start."]
+
+        limit = int(arg) if arg else MEM_TOP
+        if action == "top":
+            stats = self.take_snapshot().statistics("lineno")[:limit]
+            return [f"{format_bytes(stat.size):>10} {stat.count:>8}  {stat.traceback[0]}" for stat in stats]
+        if action == "snapshot":
+            self.baseline = self.take_snapshot()
+            return ["Baseline snapshot taken; use diff to compare against it."]
+        if action == "diff":
+            if self.baseline is None:
+                return ["No baseline yet. Take one with action snapshot."]
+            stats = self.take_snapshot().compare_to(self.baseline, "lineno")[:limit]
+            return [f"{format_bytes(stat.size_diff):>10} {stat.count_diff:>+8}  {stat.traceback[0]}" for stat in stats]
+        return self.status()
+
+    def run(self, action="status", arg=None):
+        # Called from the ping server thread: run the report on the event
+        # loop so the structures aren't walked while handlers mutate them
+        if self.loop is None or not self.loop.is_running():
+            return self.report(action, arg)
+        async def on_loop():
+            return self.report(action, arg)
+        return asyncio.run_coroutine_threadsafe(on_loop(), self.loop).result(timeout=60)
+
+MEMORY = MemoryProfiler()
 
 # ========== PING SERVER ==========
 class PingHandler(BaseHTTPRequestHandler):
     def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/mem":
+            self.memory_report(parse_qs(url.query))
+            return
         self.send_response(200)
         self.end_headers()
         self.wfile.write(b"Pong")
 
+    def memory_report(self, query):
+        token = query.get("token", [""])[0]
+        # Compare bytes: compare_digest rejects non-ASCII str with TypeError
+        if not MEM_TOKEN or not hmac.compare_digest(token.encode(), MEM_TOKEN.encode()):
+            self.send_response(404)
+            self.end_headers()
+            return
+        try:
+            lines = MEMORY.run(query.get("action", ["status"])[0], query.get("limit", [None])[0])
+            status = 200
+        except Exception as e:
+            lines, status = [f"Error: {e}"], 500
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.end_headers()
+        self.wfile.write(("\n".join(lines) + "\n").encode())
+
 def run_ping_server():
     def server_thread():
         ports = [10002, 10003]
@@ -207,10 +1275,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 #############################################################################################
 async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    access = load_access()
-
     # Only owner can execute this
-    if str(update.effective_user.id) != access.get("owner"):
+    if str(update.effective_user.id) != load_access().get("owner"):
         await update.message.reply_text("❌ Unauthorized. Only the owner can remove users.")
         return
 
@@ -221,20 +1287,24 @@ async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = context.args[0]
 
-    if user_id in access["users"]:
-        del access["users"][user_id]
-        save_access(access)
-        await update.message.reply_text(f"✅ User <b>{user_id}</b> removed successfully.", parse_mode="HTML")
+    async with ACCESS_LOCK, ALERTS_LOCK:
+        access = load_access()
+        found = user_id in access["users"]
+        if found:
+            del access["users"][user_id]
+            save_access(access)
+            pruned = prune_user_alerts(user_id)
+
+    if found:
+        await update.message.reply_text(f"✅ User <b>{user_id}</b> removed successfully ({pruned} alert(s) deleted).", parse_mode="HTML")
     else:
         await update.message.reply_text(f"⚠️ User <b>{user_id}</b> not found.",parse_mode="HTML")
 
 
 # remove coin       
 async def remove_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    access = load_access()
-
     # Only owner can execute this
-    if str(update.effective_user.id) != access.get("owner"):
+    if str(update.effective_user.id) != load_access().get("owner"):
         await update.message.reply_text("❌ Only owner can remove coins.")
         return
 
@@ -245,17 +1315,19 @@ async def remove_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = context.args[0]
     coin = context.args[1].lower()
 
-    if user_id not in access["users"]:
+    async with ACCESS_LOCK:
+        access = load_access()
+        user_data = access["users"].get(user_id)
+        coins = user_data.get("coins", []) if user_data is not None else []
+        removed = coin in coins
+        if removed:
+            coins.remove(coin)
+            user_data["coins"] = coins
+            save_access(access)
+
+    if user_data is None:
         await update.message.reply_text(f"User <b>{user_id}</b> not found.",parse_mode="HTML")
-        return
-
-    user_data = access["users"][user_id]
-    coins = user_data.get("coins", [])
-
-    if coin in coins:
-        coins.remove(coin)
-        user_data["coins"] = coins
-        save_access(access)
+    elif removed:
         await update.message.reply_text(f"<b>{coin.upper()}</b> removed from user <b>{user_id}</b>'s coin access.",parse_mode="HTML")
     else:
         await update.message.reply_text(f"<b>{coin.upper()}</b> not found in user <b>{user_id}</b>'s allowed coins.",parse_mode="HTML")
@@ -279,12 +1351,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_help = (
         "\n📌 <b>User Commands:</b>\n"
-        "<b>/add COIN PRICE [above|below]</b> - Set a price alert\n"
+        "<b>/add COIN PRICE [above|below] [CURRENCY] [EXPIRY]</b> - Set a price alert (expiry like 12h or 7d)\n"
+        "<b>/add ETH/BTC 0.05</b> or <b>/add ETH-BTC 1000</b> - Alert on the ratio or spread of two coins\n"
         "<b>/list</b> - Show your active alerts\n"
         "<b>/remove NUMBER</b> - Remove an alert\n"
         "<b>/coin</b> - Show available coins for price alerts or to check their current prices\n"
-        "<b>/price COIN [COIN2 ...</b>] - Check current price(s).\n"
+        "<b>/price COIN [COIN2 ...] [in CURRENCY]</b> - Check current price(s).\n"
         "<b>/request_coin COIN</b> - Request coin access\n"
+        "<b>/search QUERY</b> - Find a coin by symbol or name\n"
+        "<b>/digest hourly|daily|off</b> - Get a scheduled summary of your coins' prices\n"
     )
     
     owner_help = ""
@@ -297,6 +1372,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "<b>/decline_coin USER_ID COIN</b> - Decline coin\n"
             "<b>/list_users</b> - List all users\n"
             "<b>/new_coin SYMBOL COINGECKO_ID</b> - Add new cryptocurrency\n"
+            "<b>/export alerts|users|coins [csv|jsonl]</b> - Export data as a file\n"
+            "<b>/import</b> - Bulk import alerts, users or coin grants from a file\n"
+            "<b>/stats</b> - Show per-command latency and error counts\n"
+            "<b>/lag</b> - Show event loop lag and recent stalls\n"
+            "<b>/mem [start|stop|top|snapshot|diff|sizes]</b> - Profile memory use\n"
+            "<b>/channel_add CHAT_ID</b> - Register a group or channel for alerts\n"
+            "<b>/channel_alert CHAT_ID COIN PRICE [above|below] [CURRENCY]</b> - Set an alert posted to a channel\n"
+            "<b>/channels</b> - List channels and their alerts\n"
+            "<b>/channel_remove CHAT_ID [NUMBER]</b> - Remove a channel alert, or the channel\n"
         )
     
     full_help = basic_help + user_help + owner_help
@@ -324,21 +1408,28 @@ async def new_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"⚠️ {symbol.upper()} already exists in the symbol map.")
         return
     
-    # Validate CoinGecko ID using /coins/list
+    # Validate CoinGecko ID using /coins/list (cached, refreshed on a miss)
     try:
-        coin_list = requests.get("https://api.coingecko.com/api/v3/coins/list", timeout=10).json()
+        coin_list = await get_coin_catalog()
         valid_ids = {coin["id"] for coin in coin_list}
+        if coin_id not in valid_ids:
+            coin_list = await get_coin_catalog(force=True)
+            valid_ids = {coin["id"] for coin in coin_list}
         
         if coin_id not in valid_ids:
-            await update.message.reply_text(f"❌ CoinGecko ID '{coin_id}' not found. Please check the ID.")
+            suggestions = SYMBOL_INDEX.suggest(coin_id)
+            hint = f"\nClosest CoinGecko IDs: {', '.join(c for c, _ in suggestions)}" if suggestions else ""
+            await update.message.reply_text(f"❌ CoinGecko ID '{coin_id}' not found. Please check the ID.{hint}")
             return
         
-        # Save new coin
+        # Re-read: another /new_coin may have saved while we were validating
+        symbol_map = load_symbol_map()
         symbol_map[symbol] = coin_id
         save_symbol_map(symbol_map)
         
         global SYMBOL_MAP
         SYMBOL_MAP = symbol_map
+        SYMBOL_INDEX.add_tracked(symbol, coin_id)
         
         await update.message.reply_text(
             f"✅ <b>Added new coin:</b>\n\n"
@@ -406,42 +1497,68 @@ async def new_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ========== request access ==========
+# New access/coin requests are queued here and sent to the owner as one
+# digest message every REQUEST_DIGEST_INTERVAL seconds.
+REQUEST_DIGEST_INTERVAL = int(os.getenv("REQUEST_DIGEST_INTERVAL", "60"))
+REQUEST_DIGEST_MAX_LINES = 30
+OWNER_DIGEST = deque()
+
+async def send_request_digest(context: ContextTypes.DEFAULT_TYPE):
+    async with ACCESS_LOCK:
+        access = load_access()
+        expired, stamped = expire_pending_requests(access)
+        if expired or stamped:
+            save_access(access)
+    if expired:
+        print(f"🧹 Expired {expired} stale pending request(s)")
+
+    if not OWNER_DIGEST:
+        return
+
+    lines = []
+    while OWNER_DIGEST:
+        lines.append(OWNER_DIGEST.popleft())
+    shown = lines[:REQUEST_DIGEST_MAX_LINES]
+    text = f"🆕 <b>{len(lines)} new request(s)</b>\n\n" + "\n".join(html.escape(line) for line in shown)
+    if len(lines) > len(shown):
+        text += f"\n\n... and {len(lines) - len(shown)} more. Use /list_users to see all."
+    try:
+        await context.bot.send_message(chat_id=access["owner"], text=text, parse_mode="HTML")
+    except Exception as e:
+        print(f"Failed to send request digest: {e}")
+        OWNER_DIGEST.extendleft(reversed(lines))
+
 async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    access = load_access()
     user = update.effective_user
     username = user.username or user.first_name
-
-    # Already approved
-    if user_id in access["users"]:
-        await update.message.reply_text("✅ You already have access!")
+    # Replies are decided under the lock and sent after it is released
+    async with ACCESS_LOCK:
+        access = load_access()
+        error = None
+
+        # Already approved
+        if user_id in access["users"]:
+            error = "✅ You already have access!"
+        # Check if already requested
+        elif get_pending_request(access, user_id):
+            error = "⏳ Your request is already pending."
+        else:
+            access["requests"][user_id] = {
+                "user_id": user_id,
+                "username": username,
+                "timestamp": str(update.message.date),
+                "requested_at": time.time()
+            }
+            save_access(access)
+
+    if error:
+        await update.message.reply_text(error)
         return
+    await update.message.reply_text("✅ Your request has been sent to admin.")
 
-    # Check if already requested
-    pending = next((req for req in access["requests"] if req["user_id"] == user_id), None)
-    if pending:
-        await update.message.reply_text("⏳ Your request is already pending.")
-    else:
-        # Add new request
-        access["requests"].append({
-            "user_id": user_id,
-            "username": username,
-            "timestamp": str(update.message.date)
-        })
-        save_access(access)
-        await update.message.reply_text("✅ Your request has been sent to admin.")
-
-    # Notify admin (regardless of duplicate)
-    await context.bot.send_message(
-        chat_id=access["owner"],
-        text=(
-            f"🆕 <b>Access Request</b>\n\n"
-            f"User: {username} (@{user.username})\n"
-            f"ID: {user_id}\n"
-            f"Use /approve {user_id} or /decline {user_id}"
-        ),
-        parse_mode="HTML"
-    )
+    # The owner gets new requests batched in the next request digest
+    OWNER_DIGEST.append(f"👤 {username} (@{user.username}) ID: {user_id} → /approve {user_id}")
 
 # async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
 #     user_id = str(update.effective_user.id)
@@ -478,35 +1595,30 @@ async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # = Approve/Decline User Commands ==========
 async def approve_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    access = load_access()
-    
-    if user_id != access["owner"]:
-        await update.message.reply_text("❌ Only owner can approve users.")
-        return
-    
-    if not context.args:
-        await update.message.reply_text("❗ Usage: <b>/approve USER_ID</b> or <b>/decline USER_ID</b>", parse_mode="HTML")
-        return
-    
-    target_id = context.args[0]
-    request_idx = None
-    
-    for i, req in enumerate(access["requests"]):
-        if req["user_id"] == target_id:
-            request_idx = i
-            break
-    
-    if request_idx is None:
-        await update.message.reply_text("❗ No pending request for this user.")
+    target_id = context.args[0] if context.args else None
+    async with ACCESS_LOCK:
+        access = load_access()
+        error = None
+
+        if user_id != access["owner"]:
+            error = "❌ Only owner can approve users."
+        elif not target_id:
+            error = "❗ Usage: <b>/approve USER_ID</b> or <b>/decline USER_ID</b>"
+        else:
+            req = get_pending_request(access, target_id)
+            if req is None:
+                error = "❗ No pending request for this user."
+            else:
+                access["users"][target_id] = {
+                    "coins": ["btc"],
+                    "username": req["username"]
+                }
+                del access["requests"][target_id]
+                save_access(access)
+
+    if error:
+        await update.message.reply_text(error, parse_mode="HTML")
         return
-    
-    access["users"][target_id] = {
-        "coins": ["btc"],
-        "username": access["requests"][request_idx]["username"]
-    }
-    access["requests"].pop(request_idx)
-    save_access(access)
-    
     await update.message.reply_text(f"✅ Approved access for user <b>{target_id}</b>", parse_mode="HTML")
     await context.bot.send_message(
         chat_id=int(target_id),
@@ -522,31 +1634,24 @@ async def approve_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def decline_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    access = load_access()
-    
-    if user_id != access["owner"]:
-        await update.message.reply_text("❌ Only owner can decline users.")
-        return
-    
-    if not context.args:
-        await update.message.reply_text("❗ Usage: <b>/decline USER_ID</b>", parse_mode="HTML")
-        return
-    
-    target_id = context.args[0]
-    request_idx = None
-    
-    for i, req in enumerate(access["requests"]):
-        if req["user_id"] == target_id:
-            request_idx = i
-            break
-    
-    if request_idx is None:
-        await update.message.reply_text("❗ No pending request for this user.")
+    target_id = context.args[0] if context.args else None
+    async with ACCESS_LOCK:
+        access = load_access()
+        error = None
+
+        if user_id != access["owner"]:
+            error = "❌ Only owner can decline users."
+        elif not target_id:
+            error = "❗ Usage: <b>/decline USER_ID</b>"
+        elif get_pending_request(access, target_id) is None:
+            error = "❗ No pending request for this user."
+        else:
+            del access["requests"][target_id]
+            save_access(access)
+
+    if error:
+        await update.message.reply_text(error, parse_mode="HTML")
         return
-    
-    access["requests"].pop(request_idx)
-    save_access(access)
-    
     await update.message.reply_text(f"❌ Declined access for user {target_id}")
     await context.bot.send_message(
         chat_id=int(target_id),
@@ -556,89 +1661,75 @@ async def decline_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ========== COIN ACCESS MANAGEMENT ==========
 async def request_coin_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    access = load_access()
-    
-    if user_id not in access["users"]:
-        await update.message.reply_text("❌ You are not authorized to use this bot.\nUse <b>/request </b> to ask for access.",parse_mode="HTML")
-        return
-    
-    if not context.args:
-        await update.message.reply_text("❗ Usage: <b>/request_coin COIN</b>", parse_mode="HTML")
-        return
-    
-    coin = context.args[0].lower()
-    if coin not in SYMBOL_MAP:
-        await update.message.reply_text("❗ Invalid coin symbol.")
-        return
-    
-    if coin in access["users"][user_id]["coins"]:
-        await update.message.reply_text(f"✅ You already have access to <b>{coin.upper()}.</b>", parse_mode="HTML")
-        return
-    
-    for req in access["coin_requests"]:
-        if req["user_id"] == user_id and req["coin"] == coin:
-            await update.message.reply_text(f"⏳ Your request for <b>{coin.upper()}</b> is pending.", parse_mode="HTML")
-            return
-    
     user = update.effective_user
-    access["coin_requests"].append({
-        "user_id": user_id,
-        "coin": coin,
-        "username": user.username or user.first_name,
-        "timestamp": str(update.message.date)
-    })
-    save_access(access)
-    
-    await context.bot.send_message(
-        chat_id=access["owner"],
-        text=f"🆕 <b>Coin Access Request: </b>\n\n"
-             f"User: {user.username or user.first_name} (@{user.username})\n"
-             f"ID: {user_id}\n"
-             f"Coin: {coin.upper()}\n"
-             f"Use /approve_coin {user_id} {coin} or /decline_coin {user_id} {coin}",
-             parse_mode="HTML"
+    coin = context.args[0].lower() if context.args else None
+    async with ACCESS_LOCK:
+        access = load_access()
+        error = None
+
+        if user_id not in access["users"]:
+            error = "❌ You are not authorized to use this bot.\nUse <b>/request </b> to ask for access."
+        elif not coin:
+            error = "❗ Usage: <b>/request_coin COIN</b>"
+        elif coin not in SYMBOL_MAP:
+            suggestions = SYMBOL_INDEX.suggest(coin, tracked_only=True)
+            hint = f" Did you mean: {format_suggestions(suggestions)}?" if suggestions else ""
+            error = f"❗ Invalid coin symbol.{hint}"
+        elif coin in access["users"][user_id]["coins"]:
+            error = f"✅ You already have access to <b>{coin.upper()}.</b>"
+        elif get_pending_request(access, user_id, coin):
+            error = f"⏳ Your request for <b>{coin.upper()}</b> is pending."
+        else:
+            access["coin_requests"][coin_request_key(user_id, coin)] = {
+                "user_id": user_id,
+                "coin": coin,
+                "username": user.username or user.first_name,
+                "timestamp": str(update.message.date),
+                "requested_at": time.time()
+            }
+            save_access(access)
+
+    if error:
+        await update.message.reply_text(error, parse_mode="HTML")
+        return
+
+    OWNER_DIGEST.append(
+        f"🪙 {user.username or user.first_name} (@{user.username}) ID: {user_id} wants {coin.upper()} → /approve_coin {user_id} {coin}"
     )
     
     await update.message.reply_text(f"✅ Request for <b>{coin.upper()}</b> sent to admin.",parse_mode="HTML")
 
 async def approve_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    access = load_access()
-    
-    if user_id != access["owner"]:
-        await update.message.reply_text("❌ Only owner can approve coins.")
-        return
-    
-    if len(context.args) < 2:
-        await update.message.reply_text("❗ Usage: <b>/approve_coin USER_ID COIN</b> or <b>/decline_coin USER_ID COIN</b>", parse_mode="HTML")
-        return
-    
-    target_id = context.args[0]
-    coin = context.args[1].lower()
-    
-    if coin not in SYMBOL_MAP:
-        await update.message.reply_text("❗ Invalid coin symbol.")
-        return
-    
-    request_idx = None
-    for i, req in enumerate(access["coin_requests"]):
-        if req["user_id"] == target_id and req["coin"] == coin:
-            request_idx = i
-            break
-    
-    if request_idx is None:
-        await update.message.reply_text("❗ No pending request for this coin and user.")
+    target_id = context.args[0] if len(context.args) >= 2 else None
+    coin = context.args[1].lower() if len(context.args) >= 2 else None
+    async with ACCESS_LOCK:
+        access = load_access()
+        error = None
+
+        if user_id != access["owner"]:
+            error = "❌ Only owner can approve coins."
+        elif not coin:
+            error = "❗ Usage: <b>/approve_coin USER_ID COIN</b> or <b>/decline_coin USER_ID COIN</b>"
+        elif coin not in SYMBOL_MAP:
+            suggestions = SYMBOL_INDEX.suggest(coin, tracked_only=True)
+            hint = f" Did you mean: {format_suggestions(suggestions)}?" if suggestions else ""
+            error = f"❗ Invalid coin symbol.{hint}"
+        elif get_pending_request(access, target_id, coin) is None:
+            error = "❗ No pending request for this coin and user."
+        else:
+            if target_id not in access["users"]:
+                access["users"][target_id] = {"coins": []}
+
+            if coin not in access["users"][target_id]["coins"]:
+                access["users"][target_id]["coins"].append(coin)
+
+            del access["coin_requests"][coin_request_key(target_id, coin)]
+            save_access(access)
+
+    if error:
+        await update.message.reply_text(error, parse_mode="HTML")
         return
-    
-    if target_id not in access["users"]:
-        access["users"][target_id] = {"coins": []}
-    
-    if coin not in access["users"][target_id]["coins"]:
-        access["users"][target_id]["coins"].append(coin)
-    
-    access["coin_requests"].pop(request_idx)
-    save_access(access)
-    
     await update.message.reply_text(f"✅ Approved <b>{coin.upper()}</b> for user <b>{target_id}</b>", parse_mode="HTML")
     await context.bot.send_message(
         chat_id=int(target_id),
@@ -647,32 +1738,25 @@ async def approve_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def decline_coin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    access = load_access()
-    
-    if user_id != access["owner"]:
-        await update.message.reply_text("❌ Only owner can decline coins.")
+    target_id = context.args[0] if len(context.args) >= 2 else None
+    coin = context.args[1].lower() if len(context.args) >= 2 else None
+    async with ACCESS_LOCK:
+        access = load_access()
+        error = None
+
+        if user_id != access["owner"]:
+            error = "❌ Only owner can decline coins."
+        elif not coin:
+            error = "❗ Usage: /decline_coin USER_ID COIN"
+        elif get_pending_request(access, target_id, coin) is None:
+            error = "❗ No pending request for this coin and user."
+        else:
+            del access["coin_requests"][coin_request_key(target_id, coin)]
+            save_access(access)
+
+    if error:
+        await update.message.reply_text(error)
         return
-    
-    if len(context.args) < 2:
-        await update.message.reply_text("❗ Usage: /decline_coin USER_ID COIN")
-        return
-    
-    target_id = context.args[0]
-    coin = context.args[1].lower()
-    
-    request_idx = None
-    for i, req in enumerate(access["coin_requests"]):
-        if req["user_id"] == target_id and req["coin"] == coin:
-            request_idx = i
-            break
-    
-    if request_idx is None:
-        await update.message.reply_text("❗ No pending request for this coin and user.")
-        return
-    
-    access["coin_requests"].pop(request_idx)
-    save_access(access)
-    
     await update.message.reply_text(f"❌ Declined {coin.upper()} for user {target_id}")
     await context.bot.send_message(
         chat_id=int(target_id),
@@ -700,19 +1784,356 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         requests_msg = "<b>No pending access requests.</b>\n"
     else:
         requests_msg = "<b> Pending Access Requests:</b>\n\n"
-        for req in access["requests"]:
+        for req in access["requests"].values():
             requests_msg += f"- {req['username']} (ID: {req['user_id']})\n"
     
     if not access["coin_requests"]:
         coin_requests_msg = "<b>No pending coin requests.</b>\n"
     else:
         coin_requests_msg = "<b>Pending Coin Requests:</b>\n"
-        for req in access["coin_requests"]:
+        for req in access["coin_requests"].values():
             coin_requests_msg += f"- {req['username']} (ID: {req['user_id']}) for {req['coin'].upper()}\n"
     
     await update.message.reply_text(users_msg + requests_msg + coin_requests_msg, parse_mode="HTML")
 
+# ========== BULK IMPORT / EXPORT ==========
+# Rows are streamed from/to CSV or JSONL documents and applied in batches,
+# with one save per batch instead of one per row.
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+BULK_KINDS = {
+    "alerts": ["user_id", "symbol", "price", "direction", "currency", "expires_at"],
+    "users": ["user_id", "username", "coins"],
+    "coins": ["user_id", "coin"],
+}
+BULK_FORMATS = ("csv", "jsonl")
+
+def _split_coins(value):
+    if isinstance(value, list):
+        return [str(c).strip().lower() for c in value if str(c).strip()]
+    return [c.strip().lower() for c in str(value or "").replace(";", " ").replace(",", " ").split() if c.strip()]
+
+def parse_bulk_row(kind, row, allowed=None):
+    # allowed: ids that may own alerts; anything else would be dropped by
+    # the next compaction, so it is reported here instead
+    user_id = str(row.get("user_id", "")).strip()
+    if not user_id:
+        raise ValueError("missing user_id")
+
+    if kind == "alerts":
+        if allowed is not None and user_id not in allowed:
+            raise ValueError(f"unknown user_id '{user_id}'")
+        _, target = resolve_alert_target(str(row.get("symbol", "")).strip())
+        price = float(row.get("price"))
+        direction = str(row.get("direction") or "above").strip().lower()
+        if direction not in ("above", "below"):
+            raise ValueError(f"invalid direction '{direction}'")
+        currency = str(row.get("currency") or "usd").strip().lower()
+        if currency not in SUPPORTED_CURRENCIES:
+            raise ValueError(f"unsupported currency '{currency}'")
+        alert = new_alert(target, price, direction, currency)
+        if row.get("expires_at") not in (None, ""):
+            alert["expires_at"] = float(row["expires_at"])
+        return user_id, alert
+
+    if kind == "users":
+        coins = _split_coins(row.get("coins")) or ["btc"]
+        unknown = [c for c in coins if c not in SYMBOL_MAP]
+        if unknown:
+            raise ValueError(f"unsupported coin(s) {', '.join(unknown)}")
+        return user_id, {"coins": coins, "username": str(row.get("username") or "Unknown")}
+
+    coin = str(row.get("coin", "")).strip().lower()
+    if coin not in SYMBOL_MAP:
+        raise ValueError(f"unsupported coin '{coin}'")
+    return user_id, coin
+
+def iter_bulk_rows(stream, fmt):
+    # Yields (line_number, dict) pairs without materialising the whole file
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(text, start=1):
+        line = line.strip()
+        if line:
+            yield line_no, line
+
+def apply_bulk_batch(kind, batch, store):
+    # store is the alerts or access dict loaded once by import_bulk
+    if kind == "alerts":
+        for user_id, alert in batch:
+            store.setdefault(user_id, []).append(alert)
+        save_alerts(store)
+        return
+
+    for user_id, value in batch:
+        if kind == "users":
+            # Merge, so fields such as the "digest" subscription survive
+            user_data = store["users"].setdefault(user_id, {})
+            coins = user_data.setdefault("coins", [])
+            coins.extend(c for c in value["coins"] if c not in coins)
+            user_data["username"] = value["username"]
+        else:
+            user_data = store["users"].setdefault(user_id, {"coins": []})
+            if value not in user_data["coins"]:
+                user_data["coins"].append(value)
+    # Imported grants supersede any matching pending requests
+    for user_id, value in batch:
+        if kind == "users":
+            store["requests"].pop(user_id, None)
+        else:
+            store["coin_requests"].pop(coin_request_key(user_id, value), None)
+    save_access(store)
+
+def import_bulk(kind, stream, fmt):
+    # Blocking: runs in a worker thread while the caller holds the store's lock
+    store = load_alerts() if kind == "alerts" else load_access()
+    allowed = alert_owner_ids(load_access()) if kind == "alerts" else None
+    imported, errors, batch = 0, [], []
+    for line_no, row in iter_bulk_rows(stream, fmt):
+        try:
+            if isinstance(row, str):
+                row = json.loads(row)
+            batch.append(parse_bulk_row(kind, row, allowed))
+        except (ValueError, TypeError, AttributeError) as e:
+            errors.append(f"line {line_no}: {e}")
+            continue
+        if len(batch) >= BULK_BATCH_SIZE:
+            apply_bulk_batch(kind, batch, store)
+            imported += len(batch)
+            batch = []
+    if batch:
+        apply_bulk_batch(kind, batch, store)
+        imported += len(batch)
+    return imported, errors
+
+def iter_export_rows(kind):
+    if kind == "alerts":
+        for user_id, user_alerts in load_alerts(readonly=True).items():
+            for alert in user_alerts:
+                yield {
+                    "user_id": user_id,
+                    "symbol": alert["symbol"],
+                    "price": alert["price"],
+                    "direction": alert["direction"],
+                    "currency": alert.get("currency", "usd"),
+                    "expires_at": alert.get("expires_at", "")
+                }
+        return
+    for user_id, data in load_access()["users"].items():
+        if kind == "users":
+            yield {"user_id": user_id, "username": data.get("username", ""), "coins": ";".join(data.get("coins", []))}
+        else:
+            for coin in data.get("coins", []):
+                yield {"user_id": user_id, "coin": coin}
+
+def export_bulk(kind, fmt):
+    buffer = io.StringIO()
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(buffer, fieldnames=BULK_KINDS[kind])
+        writer.writeheader()
+        for row in iter_export_rows(kind):
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in iter_export_rows(kind):
+            buffer.write(json.dumps(row) + "\n")
+            count += 1
+    return io.BytesIO(buffer.getvalue().encode("utf-8")), count
+
+def _bulk_format_from_name(filename):
+    ext = os.path.splitext(filename or "")[1].lower().lstrip(".")
+    if ext in ("jsonl", "ndjson", "json"):
+        return "jsonl"
+    if ext == "csv":
+        return "csv"
+    return None
+
+async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    access = load_access()
+
+    if user_id != access["owner"]:
+        await update.message.reply_text("❌ Only owner can export data.")
+        return
+
+    kind = context.args[0].lower() if context.args else ""
+    fmt = context.args[1].lower() if len(context.args) > 1 else "csv"
+    if kind not in BULK_KINDS or fmt not in BULK_FORMATS:
+        await update.message.reply_text("❗ Usage: <b>/export alerts|users|coins [csv|jsonl]</b>", parse_mode="HTML")
+        return
+
+    # Tens of thousands of rows: build the document off the event loop
+    document, count = await asyncio.to_thread(export_bulk, kind, fmt)
+    await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=document,
+        filename=f"{kind}.{fmt}",
+        caption=f"📦 Exported {count} {kind} row(s)."
+    )
+
+async def import_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    access = load_access()
+
+    if user_id != access["owner"]:
+        await update.message.reply_text("❌ Only owner can import data.")
+        return
+
+    await update.message.reply_text(
+        "📥 <b>Bulk import</b>\n\n"
+        "Send a <b>.csv</b> or <b>.jsonl</b> file with the caption <b>/import alerts|users|coins</b>.\n\n"
+        "<b>alerts</b>: user_id, symbol, price, direction, currency, expires_at (unix time, optional)\n"
+        "<b>users</b>: user_id, username, coins (separated by ;)\n"
+        "<b>coins</b>: user_id, coin",
+        parse_mode="HTML"
+    )
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    access = load_access()
+    caption = (update.message.caption or "").split()
+
+    if not caption or caption[0].split("@")[0].lower() != "/import":
+        return
+
+    if user_id != access["owner"]:
+        await update.message.reply_text("❌ Only owner can import data.")
+        return
+
+    kind = caption[1].lower() if len(caption) > 1 else ""
+    document = update.message.document
+    fmt = _bulk_format_from_name(document.file_name)
+    if kind not in BULK_KINDS or fmt is None:
+        await update.message.reply_text("❗ Send a .csv or .jsonl file with the caption <b>/import alerts|users|coins</b>", parse_mode="HTML")
+        return
+
+    try:
+        file = await document.get_file()
+        data = await file.download_as_bytearray()
+        async with (ALERTS_LOCK if kind == "alerts" else ACCESS_LOCK):
+            imported, errors = await asyncio.to_thread(import_bulk, kind, io.BytesIO(data), fmt)
+    except Exception as e:
+        print(f"Bulk import failed: {e}")
+        await update.message.reply_text(f"⚠️ Import failed: {e}")
+        return
+
+    msg = f"✅ Imported <b>{imported}</b> {kind} row(s)."
+    if errors:
+        msg += f"\n\n⚠️ Skipped {len(errors)} invalid row(s):\n" + html.escape("\n".join(errors[:10]))
+        if len(errors) > 10:
+            msg += f"\n... and {len(errors) - 10} more"
+    await update.message.reply_text(msg, parse_mode="HTML")
+
 # ========== ALERT MANAGEMENT ==========
+CURRENCY_SIGNS = {"usd": "$", "eur": "€", "gbp": "£", "jpy": "¥", "inr": "₹", "btc": "₿", "eth": "Ξ"}
+
+def format_price(value, currency="usd", spec=""):
+    formatted = format(value, spec) if spec else str(value)
+    sign = CURRENCY_SIGNS.get(currency)
+    return f"{sign}{formatted}" if sign else f"{formatted} {currency.upper()}"
+
+MAX_ALERTS_PER_USER = int(os.getenv("MAX_ALERTS_PER_USER", "50"))
+DURATION_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+def parse_duration(value):
+    match = re.fullmatch(r"(\d+)([mhdw])", value.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        return None
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+# Pair alerts watch a value derived from two coins: ETH/BTC is the ratio
+# of their prices, ETH-BTC the spread between them in the alert currency.
+PAIR_KINDS = {"/": "ratio", "-": "spread"}
+
+def parse_pair(expr):
+    for sep, kind in PAIR_KINDS.items():
+        base, found, quote = expr.partition(sep)
+        if found and base and quote:
+            return kind, base, quote
+    return None
+
+def resolve_alert_target(target):
+    # Returns (symbols needing access, alert fields); raises ValueError
+    target = target.lower()
+    pair = parse_pair(target) if target not in SYMBOL_MAP else None
+    symbols = [pair[1], pair[2]] if pair else [target]
+    for symbol in symbols:
+        if symbol not in SYMBOL_MAP:
+            suggestions = SYMBOL_INDEX.suggest(symbol, tracked_only=True)
+            hint = f" Did you mean: {format_suggestions(suggestions)}?" if suggestions else ""
+            raise ValueError(f"Unsupported coin {symbol.upper()}.{hint}")
+    if pair and pair[1] == pair[2]:
+        raise ValueError("A pair needs two different coins.")
+    fields = {"coin": SYMBOL_MAP[symbols[0]], "symbol": target}
+    if pair:
+        fields["kind"] = pair[0]
+        fields["quote"] = SYMBOL_MAP[pair[2]]
+    return symbols, fields
+
+def alert_feed(alert):
+    # The price-map key an alert is evaluated against
+    kind = alert.get("kind")
+    if kind in ("ratio", "spread"):
+        return f"{kind}:{alert['coin']}:{alert['quote']}"
+    return alert["coin"]
+
+def format_alert_value(alert, value, spec=""):
+    # A ratio has no currency
+    if alert.get("kind") == "ratio":
+        return format(value, spec) if spec else str(value)
+    return format_price(value, alert.get("currency", "usd"), spec)
+
+def describe_alert(alert, now=None):
+    text = f"{alert['symbol'].upper()} {alert['direction']} {format_alert_value(alert, alert['price'])}"
+    if alert.get("expires_at"):
+        text += f" (expires in {format_duration(alert['expires_at'] - (now or time.time()))})"
+    return text
+
+def parse_alert_options(tokens):
+    direction = "above"
+    currency = "usd"
+    ttl = None
+    for arg in tokens:
+        arg = arg.lower()
+        if arg in ["above", "below"]:
+            direction = arg
+        elif arg in SUPPORTED_CURRENCIES:
+            currency = arg
+        elif parse_duration(arg) is not None:
+            ttl = parse_duration(arg)
+    return direction, currency, ttl
+
+def new_alert(target, price, direction, currency, ttl=None):
+    # target: the fields from resolve_alert_target
+    if target.get("kind") == "ratio":
+        # Same ratio in any currency; USD is always fetched
+        currency = "usd"
+    alert = {
+        "id": uuid.uuid4().hex,
+        **target,
+        "price": price,
+        "direction": direction,
+        "currency": currency
+    }
+    if ttl:
+        alert["expires_at"] = time.time() + ttl
+    return alert
+
+def is_alert_expired(alert, now=None):
+    expires_at = alert.get("expires_at")
+    return expires_at is not None and expires_at <= (now or time.time())
+
+def prune_user_alerts(user_id):
+    alerts = load_alerts()
+    removed = alerts.pop(str(user_id), [])
+    if removed:
+        save_alerts(alerts)
+    return len(removed)
+
 async def add_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     access = load_access()
@@ -722,18 +2143,24 @@ async def add_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if len(context.args) < 2:
-        await update.message.reply_text("❗ Usage: <b>/add COIN PRICE [above|below] </b>\n", parse_mode="HTML")
+        await update.message.reply_text(
+            "❗ Usage: <b>/add COIN PRICE [above|below] [CURRENCY] [EXPIRY e.g. 12h, 7d]</b>\n"
+            "Pairs: <b>/add ETH/BTC 0.05</b> (ratio) or <b>/add ETH-BTC 1000 below</b> (spread)\n",
+            parse_mode="HTML"
+        )
         return
     
-    symbol = context.args[0].lower()
-    coin = SYMBOL_MAP.get(symbol)
-    if not coin:
-        await update.message.reply_text("❗ Unsupported coin.")
+    try:
+        symbols, target = resolve_alert_target(context.args[0])
+    except ValueError as e:
+        await update.message.reply_text(f"❗ {e}")
         return
     
-    if user_id != access["owner"] and symbol not in access["users"][user_id]["coins"]:
-        await update.message.reply_text(f"❌ No access to <b>{symbol.upper()}.</b> Use <b>/request_coin {symbol} </b> to request access.",parse_mode="HTML")
-        return
+    if user_id != access["owner"]:
+        for symbol in symbols:
+            if symbol not in access["users"][user_id]["coins"]:
+                await update.message.reply_text(f"❌ No access to <b>{symbol.upper()}.</b> Use <b>/request_coin {symbol} </b> to request access.",parse_mode="HTML")
+                return
     
     try:
         price = float(context.args[1])
@@ -741,22 +2168,24 @@ async def add_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❗ Invalid price.")
         return
     
-    direction = "above"
-    if len(context.args) >= 3 and context.args[2].lower() in ["above", "below"]:
-        direction = context.args[2].lower()
+    direction, currency, ttl = parse_alert_options(context.args[2:])
     
-    alerts = load_alerts()
-    user_alerts = alerts.get(user_id, [])
-    user_alerts.append({
-        "coin": coin,
-        "symbol": symbol,
-        "price": price,
-        "direction": direction
-    })
-    alerts[user_id] = user_alerts
-    save_alerts(alerts)
-     
-    await update.message.reply_text(f"✅ <b> Alert set for {symbol.upper()} ${price} ({direction})</b>\n\nYou will be notified when the price condition is met.", parse_mode="HTML")
+    # The reply is decided under the lock and sent after it is released
+    async with ALERTS_LOCK:
+        alerts = load_alerts()
+        user_alerts = alerts.get(user_id, [])
+        at_limit = user_id != access["owner"] and len(user_alerts) >= MAX_ALERTS_PER_USER
+        if not at_limit:
+            alert = new_alert(target, price, direction, currency, ttl)
+            user_alerts.append(alert)
+            alerts[user_id] = user_alerts
+            save_alerts(alerts)
+    
+    if at_limit:
+        await update.message.reply_text(f"❗ You already have {len(user_alerts)} alerts (limit {MAX_ALERTS_PER_USER}). Use <b>/remove</b> to free one up.", parse_mode="HTML")
+        return
+    expiry = f"\nExpires in {format_duration(ttl)}." if ttl else ""
+    await update.message.reply_text(f"✅ <b> Alert set for {target['symbol'].upper()} {format_alert_value(alert, price)} ({direction})</b>\n\nYou will be notified when the price condition is met.{expiry}", parse_mode="HTML")
 
 #list alerts
 async def list_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -767,7 +2196,7 @@ async def list_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ You are not authorized to use this bot.\nUse <b>/request </b> to ask for access.",parse_mode="HTML")
         return
     
-    alerts = load_alerts()
+    alerts = load_alerts(readonly=True)
     user_alerts = alerts.get(user_id, [])
     
     if not user_alerts:
@@ -776,7 +2205,7 @@ async def list_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     msg = "📋 <b>Your alerts:</b>\n\n"
     for i, alert in enumerate(user_alerts, start=1):
-        msg += f"{i}. {alert['symbol'].upper()} {alert['direction']} ${alert['price']}\n"
+        msg += f"{i}. {describe_alert(alert)}\n"
     await update.message.reply_text(msg,parse_mode="HTML")
 
 
@@ -794,24 +2223,177 @@ async def remove_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     idx = int(context.args[0]) - 1
-    alerts = load_alerts()
-    user_alerts = alerts.get(user_id, [])
+    async with ALERTS_LOCK:
+        alerts = load_alerts()
+        user_alerts = alerts.get(user_id, [])
+        removed = user_alerts.pop(idx) if 0 <= idx < len(user_alerts) else None
+        if removed is not None:
+            if user_alerts:
+                alerts[user_id] = user_alerts
+            else:
+                alerts.pop(user_id)
+            save_alerts(alerts)
     
-    if idx < 0 or idx >= len(user_alerts):
+    if removed is None:
         await update.message.reply_text("❗ Invalid alert number.")
         return
-    
-    removed = user_alerts.pop(idx)
-    if user_alerts:
-        alerts[user_id] = user_alerts
-    else:
-        alerts.pop(user_id)
-    save_alerts(alerts)
-    
     await update.message.reply_text(
-        f"✅ Removed alert for <b>{removed['symbol'].upper()} ${removed['price']} ({removed['direction']})</b>", parse_mode="HTML"
+        f"✅ Removed alert for <b>{removed['symbol'].upper()} {format_alert_value(removed, removed['price'])} ({removed['direction']})</b>", parse_mode="HTML"
+    )
+
+# ========== CHANNEL ALERTS ==========
+# The owner can register groups/channels the bot posts in and set alerts
+# for them. Channel alerts are stored in prices.json under the chat id like
+# a user's, so they share index entries with identical user alerts.
+async def channel_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) != load_access()["owner"]:
+        await update.message.reply_text("❌ Only owner can manage channels.")
+        return
+
+    if len(context.args) != 1:
+        await update.message.reply_text("❗ Usage: <b>/channel_add CHAT_ID</b> (or @channelname)", parse_mode="HTML")
+        return
+
+    try:
+        chat = await context.bot.get_chat(context.args[0])
+    except Exception as e:
+        await update.message.reply_text(f"❌ Can't reach {context.args[0]}: {e}\nAdd the bot to the group or channel first.")
+        return
+
+    chat_id = str(chat.id)
+    async with ACCESS_LOCK:
+        access = load_access()
+        access.setdefault("channels", {})[chat_id] = {"title": chat.title or chat.username or chat_id, "type": chat.type}
+        save_access(access)
+
+    await update.message.reply_text(
+        f"✅ Added <b>{html.escape(chat.title or chat_id)}</b> (ID: {chat_id})\n\nUse <b>/channel_alert {chat_id} COIN PRICE</b> to set alerts for it.",
+        parse_mode="HTML"
     )
 
+async def channel_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) != load_access()["owner"]:
+        await update.message.reply_text("❌ Only owner can manage channels.")
+        return
+
+    if not context.args or len(context.args) > 2 or (len(context.args) == 2 and not context.args[1].isdigit()):
+        await update.message.reply_text("❗ Usage: <b>/channel_remove CHAT_ID [ALERT_NUMBER]</b>", parse_mode="HTML")
+        return
+
+    chat_id = context.args[0]
+    if len(context.args) == 2:
+        idx = int(context.args[1]) - 1
+        async with ALERTS_LOCK:
+            alerts = load_alerts()
+            chat_alerts = alerts.get(chat_id, [])
+            removed = chat_alerts.pop(idx) if 0 <= idx < len(chat_alerts) else None
+            if removed:
+                if not chat_alerts:
+                    alerts.pop(chat_id)
+                save_alerts(alerts)
+        if removed is None:
+            await update.message.reply_text("❗ Invalid alert number.")
+        else:
+            await update.message.reply_text(f"✅ Removed channel alert <b>{describe_alert(removed)}</b>", parse_mode="HTML")
+        return
+
+    async with ACCESS_LOCK, ALERTS_LOCK:
+        access = load_access()
+        channel = access.get("channels", {}).pop(chat_id, None)
+        if channel is not None:
+            save_access(access)
+            pruned = prune_user_alerts(chat_id)
+
+    if channel is None:
+        await update.message.reply_text(f"⚠️ Channel <b>{chat_id}</b> not found.", parse_mode="HTML")
+    else:
+        await update.message.reply_text(f"✅ Removed <b>{html.escape(channel['title'])}</b> ({pruned} alert(s) deleted).", parse_mode="HTML")
+
+async def channel_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    access = load_access()
+    if str(update.effective_user.id) != access["owner"]:
+        await update.message.reply_text("❌ Only owner can manage channels.")
+        return
+
+    if len(context.args) < 3:
+        await update.message.reply_text("❗ Usage: <b>/channel_alert CHAT_ID COIN PRICE [above|below] [CURRENCY] [EXPIRY]</b>", parse_mode="HTML")
+        return
+
+    chat_id = context.args[0]
+    if chat_id not in access.get("channels", {}):
+        await update.message.reply_text(f"❗ Unknown channel. Register it with <b>/channel_add {chat_id}</b> first.", parse_mode="HTML")
+        return
+
+    try:
+        _, target = resolve_alert_target(context.args[1])
+    except ValueError as e:
+        await update.message.reply_text(f"❗ {e}")
+        return
+
+    try:
+        price = float(context.args[2])
+    except ValueError:
+        await update.message.reply_text("❗ Invalid price.")
+        return
+
+    direction, currency, ttl = parse_alert_options(context.args[3:])
+    async with ALERTS_LOCK:
+        alerts = load_alerts()
+        alert = new_alert(target, price, direction, currency, ttl)
+        alerts.setdefault(chat_id, []).append(alert)
+        save_alerts(alerts)
+
+    title = html.escape(access["channels"][chat_id]["title"])
+    await update.message.reply_text(f"✅ <b>Alert set for {describe_alert(alert)}</b> in {title}", parse_mode="HTML")
+
+async def list_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    access = load_access()
+    if str(update.effective_user.id) != access["owner"]:
+        await update.message.reply_text("❌ Only owner can manage channels.")
+        return
+
+    channels = access.get("channels", {})
+    if not channels:
+        await update.message.reply_text("No channels registered. Use <b>/channel_add CHAT_ID</b>.", parse_mode="HTML")
+        return
+
+    alerts = load_alerts(readonly=True)
+    msg = "📣 <b>Channels:</b>\n"
+    for chat_id, channel in channels.items():
+        msg += f"\n<b>{html.escape(channel['title'])}</b> (ID: {chat_id})\n"
+        for i, alert in enumerate(alerts.get(chat_id, []), start=1):
+            msg += f"  {i}. {describe_alert(alert)}\n"
+    await update.message.reply_text(msg, parse_mode="HTML")
+
+# ========== SEARCH COMMAND ==========
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    access = load_access()
+
+    if user_id != access["owner"] and user_id not in access["users"]:
+        await update.message.reply_text("❌ You are not authorized to use this bot.\nUse <b>/request </b> to ask for access.",parse_mode="HTML")
+        return
+
+    if not context.args:
+        await update.message.reply_text("❗ Usage: <b>/search QUERY</b>", parse_mode="HTML")
+        return
+
+    query = " ".join(context.args)
+    is_owner = user_id == access["owner"]
+    # Only the owner can add catalog coins, so only the owner sees them
+    suggestions = SYMBOL_INDEX.suggest(query, limit=10, tracked_only=not is_owner)
+    if not suggestions:
+        await update.message.reply_text(f"No coins match '{query}'.")
+        return
+
+    lines = [f"🔎 <b>Matches for '{html.escape(query)}':</b>\n"]
+    for coin_id, symbol in suggestions:
+        if symbol:
+            lines.append(f"• {symbol.upper()} ({html.escape(coin_id)})")
+        else:
+            lines.append(f"• {html.escape(coin_id)} - add with /new_coin SYMBOL {html.escape(coin_id)}")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
 # ========== COIN COMMAND ==========
 async def coin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
@@ -907,12 +2489,22 @@ async def get_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if not context.args:
         await update.message.reply_text(
-            "❗ Usage: <b>/price COIN [COIN2 ...]</b>",
+            "❗ Usage: <b>/price COIN [COIN2 ...] [in CURRENCY]</b>",
             parse_mode="HTML"
         )
         return
 
     symbols = [s.lower() for s in context.args]
+    currency = "usd"
+    if len(symbols) >= 3 and symbols[-2] == "in":
+        currency = symbols[-1]
+        symbols = symbols[:-2]
+        if currency not in SUPPORTED_CURRENCIES:
+            await update.message.reply_text(
+                f"❗ Unsupported currency. Use one of: {', '.join(c.upper() for c in SUPPORTED_CURRENCIES)}",
+                parse_mode="HTML"
+            )
+            return
 
     if user_id != access["owner"]:
         accessible_coins = access["users"][user_id].get("coins", [])
@@ -927,8 +2519,13 @@ async def get_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     unknown = [s for s in symbols if s not in SYMBOL_MAP]
     if unknown:
+        lines = [f"❗ Unknown coin(s): {', '.join(unknown)}"]
+        for s in unknown:
+            suggestions = SYMBOL_INDEX.suggest(s, tracked_only=True)
+            if suggestions:
+                lines.append(f"{s} → did you mean {format_suggestions(suggestions)}?")
         await update.message.reply_text(
-            f"❗ Unknown coin(s): {', '.join(unknown)}",
+            html.escape("\n".join(lines)),
             parse_mode="HTML"
         )
         return
@@ -936,28 +2533,24 @@ async def get_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ids = [SYMBOL_MAP[s] for s in symbols]
 
     try:
-        # Attempt request with retry
-        for attempt in range(2):  # Try up to 2 times
-            try:
-                res = requests.get(
-                    "https://api.coingecko.com/api/v3/simple/price",
-                    params={"ids": ",".join(ids), "vs_currencies": "usd"},
-                    timeout=10
-                ).json()
-                break  # If success, break loop
-            except Timeout:
-                if attempt == 1:
-                    raise  # Raise on final try
+        res, stale = await UPSTREAM.recent_prices(ids, [currency])
         # Parse result
         lines = []
         for s in symbols:
-            price = res.get(SYMBOL_MAP[s], {}).get("usd")
+            price = res.get(SYMBOL_MAP[s], {}).get(currency)
             if price is not None:
-                lines.append(f"💰 {s.upper()}: ${price:.5f}")
+                line = f"💰 {s.upper()}: {format_price(price, currency, '.5f')}"
+                if SYMBOL_MAP[s] in stale:
+                    line += f" (stale, {format_age(stale[SYMBOL_MAP[s]])} old)"
+                lines.append(line)
             else:
                 lines.append(f"⚠️ {s.upper()}: Price not found. Try again later.")
         await update.message.reply_text("\n".join(lines))
 
+    except CircuitOpen as e:
+        await update.message.reply_text(f"⏳ Price service is cooling down. Try again in {max(1, int(e.retry_in))} seconds.")
+    except RateLimited:
+        await update.message.reply_text("⏳ Price service is rate limited. Try again in a few seconds.")
     except Timeout:
         await update.message.reply_text("⏱️ Request timed out. Try again in a few seconds.")
     except RequestException as e:
@@ -970,54 +2563,673 @@ async def get_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Unknown command. Use /help for available commands.")
 
-# ========== PRICE CHECKING ==========
-async def check_prices(context: ContextTypes.DEFAULT_TYPE):
+# ========== PRICE DIGEST ==========
+# /digest hourly|daily subscribes a user to a summary of their allowed
+# coins. One job at the top of every hour fetches all subscribed coins in
+# a single batched request, renders one message per (interval, coin set)
+# and queues a copy per subscriber in the outbox, whose rate-limited
+# drain delivers them. The subscription lives in the user's access.json
+# record ("digest"); the owner's in access["owner_price_digest"].
+# The job always stays on the hour, also after a warm restart; a slot
+# missed while the bot was down is sent once on startup, keyed by that
+# slot so the outbox drops it if it did go out.
+DIGEST_INTERVALS = ("hourly", "daily")
+DIGEST_DAILY_HOUR = int(os.getenv("DIGEST_DAILY_HOUR", "8"))  # UTC
+# interval -> coin -> price at the previous digest of that interval
+DIGEST_PRICES = {interval: {} for interval in DIGEST_INTERVALS}
+
+def seconds_until_next_hour(now=None):
+    now = now or time.time()
+    return 3600 - now % 3600
+
+def due_digest_intervals(now=None):
+    hour = time.gmtime(now or time.time()).tm_hour
+    return [interval for interval in DIGEST_INTERVALS if interval == "hourly" or hour == DIGEST_DAILY_HOUR]
+
+def missed_digest_slots(last_run, now=None):
+    # Returns {interval: hour slot} for the latest top-of-hour run of each
+    # interval that fell after last_run
+    if last_run is None:
+        return {}
+    now = now or time.time()
+    missed = {}
+    for slot in range(int(now // 3600), int(last_run // 3600), -1):
+        for interval in due_digest_intervals(slot * 3600):
+            missed.setdefault(interval, slot)
+        if len(missed) == len(DIGEST_INTERVALS):
+            break
+    return missed
+
+def digest_subscribers(access, intervals):
+    # Returns [(chat_id, interval, coin symbols)]
+    subscribers = []
+    if access.get("owner_price_digest") in intervals:
+        subscribers.append((access["owner"], access["owner_price_digest"], list(SYMBOL_MAP)))
+    for user_id, data in access["users"].items():
+        if data.get("digest") in intervals:
+            subscribers.append((user_id, data["digest"], data.get("coins", [])))
+    return subscribers
+
+def format_change(current, previous):
+    if not previous:
+        return ""
+    return f" ({(current - previous) / previous * 100:+.2f}%)"
+
+def render_digest(interval, symbols, prices, stale):
+    lines = [f"📰 {interval.capitalize()} price digest", ""]
+    previous = DIGEST_PRICES[interval]
+    for symbol in symbols:
+        coin = SYMBOL_MAP[symbol]
+        price = prices.get(coin, {}).get("usd")
+        if price is None:
+            lines.append(f"{symbol.upper()}: unavailable")
+            continue
+        line = f"{symbol.upper()}: {format_price(price, 'usd', ',.2f' if price >= 1 else '.6g')}{format_change(price, previous.get(coin))}"
+        if coin in stale:
+            line += f" (stale, {format_age(stale[coin])} old)"
+        lines.append(line)
+    lines.append("")
+    lines.append("Change is since the previous digest. /digest off to stop.")
+    return "\n".join(lines)
+
+async def queue_digests(context, slots):
+    # slots: {interval: hour slot the digest is for}
+    subscribers = digest_subscribers(load_access(), list(slots))
+    if not subscribers:
+        return
+
+    # Group by (interval, coin set) so each distinct message is built once
+    groups = {}
+    for chat_id, interval, symbols in subscribers:
+        symbols = tuple(sorted(s for s in set(symbols) if s in SYMBOL_MAP))
+        if symbols:
+            groups.setdefault((interval, symbols), []).append(chat_id)
+    coins = {SYMBOL_MAP[s] for _, symbols in groups for s in symbols}
+
     try:
-        alerts = load_alerts()
-        if not alerts:
+        prices, stale = await UPSTREAM.fetch_prices(coins, ["usd"])
+    except Exception as e:
+        print(f"Digest skipped, price fetch failed: {e}")
+        return
+
+    queued = 0
+    for (interval, symbols), chat_ids in groups.items():
+        text = render_digest(interval, symbols, prices, stale)
+        for chat_id in chat_ids:
+            # Keyed by hour slot so a restart within the hour can't resend
+            if OUTBOX.enqueue(f"digest:{interval}:{slots[interval]}:{chat_id}", chat_id, text):
+                queued += 1
+    OUTBOX.save()
+
+    for interval in slots:
+        DIGEST_PRICES[interval].update({
+            coin: quoted["usd"] for coin, quoted in prices.items()
+            if coin not in stale and "usd" in quoted
+        })
+    print(f"📰 Queued {queued} digest(s): {len(groups)} distinct, {len(coins)} coins in one fetch")
+    context.job_queue.run_once(timed("drain_outbox", drain_outbox), 0)
+
+async def send_digests(context: ContextTypes.DEFAULT_TYPE):
+    now = time.time()
+    slot = int(now // 3600)
+    await queue_digests(context, {interval: slot for interval in due_digest_intervals(now)})
+
+async def catch_up_digests(context: ContextTypes.DEFAULT_TYPE):
+    missed = context.job.data
+    print(f"📰 Catching up missed digest(s): {', '.join(missed)}")
+    await queue_digests(context, missed)
+
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    access = load_access()
+    is_owner = user_id == access["owner"]
+
+    if not is_owner and user_id not in access["users"]:
+        await update.message.reply_text("❌ You are not authorized to use this bot.\nUse <b>/request </b> to ask for access.",parse_mode="HTML")
+        return
+
+    current = access.get("owner_price_digest") if is_owner else access["users"][user_id].get("digest")
+    if not context.args:
+        status = f"<b>{current}</b>" if current else "<b>off</b>"
+        await update.message.reply_text(f"📰 Your price digest is {status}.\nUse <b>/digest hourly|daily|off</b> to change it.", parse_mode="HTML")
+        return
+
+    choice = context.args[0].lower()
+    if choice not in DIGEST_INTERVALS + ("off",):
+        await update.message.reply_text("❗ Usage: <b>/digest hourly|daily|off</b>", parse_mode="HTML")
+        return
+
+    async with ACCESS_LOCK:
+        access = load_access()
+        if is_owner:
+            record = access
+            key = "owner_price_digest"
+        elif user_id in access["users"]:
+            record = access["users"][user_id]
+            key = "digest"
+        else:
             return
+        if choice == "off":
+            record.pop(key, None)
+        else:
+            record[key] = choice
+        save_access(access)
+
+    if choice == "off":
+        await update.message.reply_text("✅ Price digest turned off.")
+    elif choice == "hourly":
+        await update.message.reply_text("✅ You'll get a digest of your coins at the top of every hour.")
+    else:
+        await update.message.reply_text(f"✅ You'll get a digest of your coins every day at {DIGEST_DAILY_HOUR:02d}:00 UTC.")
+
+# ========== STATS COMMAND ==========
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    access = load_access()
+
+    if user_id != access["owner"]:
+        await update.message.reply_text("❌ Only owner can view stats.")
+        return
+
+    rows = STATS.summary()
+    if not rows:
+        await update.message.reply_text("No handler timings recorded yet.")
+        return
+
+    index = _ALERT_INDEX_CACHE["index"]
+    index_line = f"\nAlert index: <b>{index.size}</b> alerts in <b>{index.subscriptions}</b> distinct thresholds" if index else ""
+    lines = [f"{'handler':<20}{'calls':>7}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}"]
+    for name, calls, errors, p50, p95, p99 in rows:
+        lines.append(f"{name[:20]:<20}{calls:>7}{errors:>5}{_ms(p50):>9}{_ms(p95):>9}{_ms(p99):>9}")
+    await update.message.reply_text(
+        f"📈 <b>Handler latency (ms, last {STATS.window} calls)</b>\n\n<pre>{html.escape(chr(10).join(lines))}</pre>\n"
+        f"Upstream circuit: <b>{UPSTREAM.breaker.state}</b>{index_line}\n"
+        f"Tick: every {TICK.interval:.0f}s, <b>{TICK.skipped}</b> skipped after overruns",
+        parse_mode="HTML"
+    )
+
+async def lag_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    access = load_access()
 
-        coins = list({alert['coin'] for alerts in alerts.values() for alert in alerts})
-        prices = requests.get(
-            "https://api.coingecko.com/api/v3/simple/price",
-            params={"ids": ",".join(coins), "vs_currencies": "usd"},
-            timeout=10
-        ).json()
+    if user_id != access["owner"]:
+        await update.message.reply_text("❌ Only owner can view loop lag.")
+        return
+
+    p50, p95, p99 = STATS.percentiles("loop.lag")
+    worst = max(STATS.samples.get("loop.lag", ()), default=None)
+    msg = (
+        "🐢 <b>Event loop lag (ms)</b>\n\n"
+        f"p50: {_ms(p50)}  p95: {_ms(p95)}  p99: {_ms(p99)}  max: {_ms(worst)}\n"
+        f"Threshold: {LOOP_MONITOR.threshold * 1000:.0f} ms\n"
+    )
+    if not LOOP_MONITOR.stalls:
+        msg += "\nNo stalls recorded."
+    else:
+        msg += "\n<b>Recent stalls:</b>\n"
+        for stall in list(LOOP_MONITOR.stalls)[-5:]:
+            last_frame = stall["stack"].strip().splitlines()[-2:] if stall["stack"] else []
+            msg += (
+                f"\n• {time.strftime('%H:%M:%S', time.localtime(stall['at']))} "
+                f"{stall['stalled'] * 1000:.0f} ms+ in {html.escape(stall['running'])}\n"
+            )
+            if last_frame:
+                msg += f"<pre>{html.escape(chr(10).join(line.strip() for line in last_frame))}</pre>\n"
+    await update.message.reply_text(msg, parse_mode="HTML")
+
+async def mem_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    access = load_access()
+
+    if user_id != access["owner"]:
+        await update.message.reply_text("❌ Only owner can profile memory.")
+        return
+
+    action = context.args[0].lower() if context.args else "status"
+    arg = context.args[1] if len(context.args) > 1 else None
+    if arg is not None and not arg.isdigit():
+        await update.message.reply_text("❗ Usage: <b>/mem [status|start [FRAMES]|stop|top [N]|snapshot|diff [N]|sizes]</b>", parse_mode="HTML")
+        return
 
-        for user_id, user_alerts in list(alerts.items()):
-            to_remove = []
+    try:
+        lines = MEMORY.report(action, arg)
+    except Exception as e:
+        print(f"Memory report failed: {e}")
+        await update.message.reply_text(f"⚠️ Memory report failed: {e}")
+        return
+    text = "\n".join(lines)
+    if len(text) > 3800:
+        text = text[:3800] + "\n..."
+    await update.message.reply_text(f"🧠 <b>Memory: {html.escape(action)}</b>\n\n<pre>{html.escape(text)}</pre>", parse_mode="HTML")
+
+# ========== ALERT INDEX ==========
+# Alerts are partitioned by (coin, currency) and sorted by threshold, so a
+# tick finds every triggered alert with two bisects per partition instead
+# of comparing each alert. Pair alerts get their own partition under a
+# feed key (see alert_feed) whose value derive() computes from the coin
+# prices once per tick. Identical (feed, currency, direction, price)
+# alerts share one subscription holding all their subscribers, so the
+# index grows with distinct thresholds rather than with users. The index
+# is rebuilt only when alerts change.
+class AlertIndex:
+    def __init__(self, alerts):
+        self.size = 0
+        self.subscriptions = 0
+        self.partitions = {}
+        # feed -> (kind, coin, quote coin) for ratio/spread feeds
+        self.pairs = {}
+        for user_id, user_alerts in alerts.items():
             for i, alert in enumerate(user_alerts):
-                current = prices.get(alert["coin"], {}).get("usd")
-                if current is None:
+                direction = alert.get("direction")
+                if direction not in ("above", "below"):
                     continue
-                
-                condition_met = (
-                    (alert["direction"] == "above" and current >= alert["price"]) or
-                    (alert["direction"] == "below" and current <= alert["price"])
-                )
-                
-                if condition_met:
-                    try:
-                        await context.bot.send_message(
-                            chat_id=int(user_id),
-                            text=f"🚨 {alert['symbol'].upper()} ${current:.2f} hit {alert['direction']} ${alert['price']}!"
-                        )
-                        to_remove.append(i)
-                    except Exception as e:
-                        print(f"Failed to notify user {user_id}: {e}")
-            
-            for i in reversed(to_remove):
-                user_alerts.pop(i)
-            
-            if user_alerts:
-                alerts[user_id] = user_alerts
+                feed = alert_feed(alert)
+                if feed != alert["coin"]:
+                    self.pairs[feed] = (alert["kind"], alert["coin"], alert["quote"])
+                key = (feed, alert.get("currency", "usd"))
+                part = self.partitions.setdefault(key, {"above": {}, "below": {}})
+                part[direction].setdefault(alert["price"], []).append((user_id, i, alert))
+                self.size += 1
+        for part in self.partitions.values():
+            for direction, subscribers in part.items():
+                thresholds = sorted(subscribers)
+                part[direction] = (thresholds, [subscribers[price] for price in thresholds])
+                self.subscriptions += len(thresholds)
+
+    def coins(self):
+        coins = set()
+        for feed, _ in self.partitions:
+            if feed in self.pairs:
+                coins.update(self.pairs[feed][1:])
             else:
-                alerts.pop(user_id)
-        
-        save_alerts(alerts)
+                coins.add(feed)
+        return coins
+
+    def derive(self, prices):
+        # Returns the price map plus one value per distinct pair feed and
+        # currency; a pair with a missing (or stale) leg is left out
+        if not self.pairs:
+            return prices
+        prices = dict(prices)
+        for feed, currency in self.partitions:
+            pair = self.pairs.get(feed)
+            if pair is None:
+                continue
+            kind, coin, quote = pair
+            a = prices.get(coin, {}).get(currency)
+            b = prices.get(quote, {}).get(currency)
+            if a is None or b is None or (kind == "ratio" and not b):
+                continue
+            prices.setdefault(feed, {})[currency] = a / b if kind == "ratio" else a - b
+        return prices
+
+    def currencies(self):
+        return {currency for _, currency in self.partitions}
+
+    def triggered_subscriptions(self, prices):
+        # Returns [(subscribers, current_price)], one per crossed threshold
+        hits = []
+        for (coin, currency), part in self.partitions.items():
+            current = prices.get(coin, {}).get(currency)
+            if current is None:
+                continue
+            thresholds, subscriptions = part["above"]
+            for subscribers in subscriptions[:bisect.bisect_right(thresholds, current)]:
+                hits.append((subscribers, current))
+            thresholds, subscriptions = part["below"]
+            for subscribers in subscriptions[bisect.bisect_left(thresholds, current):]:
+                hits.append((subscribers, current))
+        return hits
+
+    def triggered(self, prices):
+        # Returns [(user_id, alert_position, alert, current_price)]
+        return [
+            (user_id, i, alert, current)
+            for subscribers, current in self.triggered_subscriptions(prices)
+            for user_id, i, alert in subscribers
+        ]
+
+_ALERT_INDEX_CACHE = {"version": None, "index": None}
+
+def get_alert_index(alerts):
+    version = alerts_version()
+    if _ALERT_INDEX_CACHE["version"] != version:
+        _ALERT_INDEX_CACHE["index"] = AlertIndex(alerts)
+        _ALERT_INDEX_CACHE["version"] = version
+    return _ALERT_INDEX_CACHE["index"]
+
+# ========== TICK SCHEDULER ==========
+# check_prices runs from one loop instead of run_repeating, so two ticks
+# can never overlap. A tick that overruns its slot makes the loop skip the
+# slots it missed and resume on the original grid, instead of firing a
+# burst of catch-up ticks. Each phase has a budget: the fetch budget is
+# passed to the upstream client as a deadline, so requests and retries
+# stop when it runs out and unfetched coins count as stale (they can't
+# trigger). A fetch is never started while the previous tick's is still
+# running. The CPU-bound phases can't be interrupted, so their overruns
+# are only recorded. Overruns show up in /stats
+# as tick.<phase>.overrun (how far over) and skipped slots as tick.skipped.
+TICK_INTERVAL = float(os.getenv("TICK_INTERVAL", "15"))
+TICK_BUDGETS = {
+    "fetch": float(os.getenv("TICK_FETCH_BUDGET", "8")),
+    "evaluate": float(os.getenv("TICK_EVALUATE_BUDGET", "0.5")),
+    "notify": float(os.getenv("TICK_NOTIFY_BUDGET", "1")),
+    "persist": float(os.getenv("TICK_PERSIST_BUDGET", "1")),
+}
+
+# The tick's fetch task; shielded, so it stays "running" for as long as its
+# worker thread does even if the tick awaiting it is cancelled
+_TICK_FETCH = {"task": None}
+
+@contextmanager
+def tick_phase(phase):
+    start = time.perf_counter()
+    try:
+        with STATS.phase(f"tick.{phase}"):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        budget = TICK_BUDGETS[phase]
+        if elapsed > budget:
+            STATS.record(f"tick.{phase}.overrun", elapsed - budget)
+            print(f"⏱️ Tick {phase} took {elapsed:.2f}s (budget {budget:.2f}s)")
+
+class TickScheduler:
+    def __init__(self, name, callback, interval=TICK_INTERVAL):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.skipped = 0
+
+    async def run(self, app, first=0):
+        loop = asyncio.get_running_loop()
+        context = CallbackContext(app)
+        job = scheduled(self.name, self.callback)
+        next_at = loop.time() + first
+        while True:
+            await asyncio.sleep(max(0, next_at - loop.time()))
+            await job(context)
+            next_at += self.interval
+            late = loop.time() - next_at
+            if late > 0:
+                missed = int(late // self.interval) + 1
+                next_at += missed * self.interval
+                self.skipped += missed
+                STATS.record("tick.skipped", late)
+                print(f"⏱️ {self.name} overran its slot by {late:.1f}s; skipped {missed} tick(s)")
+
+# ========== PRICE CHECKING ==========
+def alert_message(alert, current):
+    spec = ".6g" if alert.get("kind") == "ratio" else ".2f"
+    return f"🚨 {alert['symbol'].upper()} {format_alert_value(alert, current, spec)} hit {alert['direction']} {format_alert_value(alert, alert['price'])}!"
+
+def evaluate_alerts(index, prices, now=None):
+    # Shared by the live tick and the backtester, which passes the replayed
+    # tick's time. Expired alerts wait for compaction but must not fire.
+    now = now or time.time()
+    with tick_phase("evaluate"):
+        return [hit for hit in index.triggered(index.derive(prices)) if not is_alert_expired(hit[2], now)]
+
+def remove_alerts_by_id(alerts, ids):
+    for user_id in list(alerts):
+        live = [alert for alert in alerts[user_id] if alert.get("id") not in ids]
+        if live:
+            alerts[user_id] = live
+        else:
+            del alerts[user_id]
+
+async def check_prices(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        async with ALERTS_LOCK:
+            alerts = load_alerts(readonly=True)
+            if not alerts:
+                return
+            if any("id" not in alert for user_alerts in alerts.values() for alert in user_alerts):
+                alerts = load_alerts()
+                assign_alert_ids(alerts)
+                save_alerts(alerts)
+
+        index = get_alert_index(alerts)
+
+        previous = _TICK_FETCH["task"]
+        if previous is not None and not previous.done():
+            STATS.record("tick.fetch.busy", 0)
+            print("⏱️ Previous price fetch is still running; skipping this tick")
+            return
+
+        with tick_phase("fetch"):
+            # One request per chunk of coins covers every quote currency
+            deadline = time.monotonic() + TICK_BUDGETS["fetch"]
+            task = _TICK_FETCH["task"] = asyncio.ensure_future(UPSTREAM.fetch_prices(index.coins(), index.currencies(), deadline))
+            # Marks a late failure as retrieved if this tick is cancelled
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            prices, stale = await asyncio.shield(task)
+            # Never trigger on last-known prices; wait for fresh data
+            for coin in stale:
+                prices.pop(coin, None)
+
+        triggered = evaluate_alerts(index, prices)
+        if not triggered:
+            return
+
+        async with ALERTS_LOCK:
+            # Commands may have changed the store during the fetch, so
+            # re-read it, skip alerts removed meanwhile and delete by id
+            # rather than by position. remove_alerts_by_id only replaces
+            # top-level lists, so a shallow copy of the shared view will do.
+            alerts = dict(load_alerts(readonly=True))
+            live_ids = {alert["id"] for user_alerts in alerts.values() for alert in user_alerts}
+            triggered = [hit for hit in triggered if hit[2]["id"] in live_ids]
+
+            with tick_phase("notify"):
+                # Outbox first: if we crash before the alerts are saved, the
+                # alert re-triggers next tick and is deduped by its id.
+                # Subscribers of the same threshold share one rendered text.
+                texts = {}
+                for user_id, i, alert, current in triggered:
+                    key = (alert["symbol"], alert.get("currency", "usd"), alert["direction"], alert["price"], current)
+                    if key not in texts:
+                        texts[key] = alert_message(alert, current)
+                    OUTBOX.enqueue(alert["id"], user_id, texts[key])
+                OUTBOX.save()
+
+            with tick_phase("persist"):
+                remove_alerts_by_id(alerts, {hit[2]["id"] for hit in triggered})
+                save_alerts(alerts)
+
+        context.job_queue.run_once(timed("drain_outbox", drain_outbox), 0)
     except Exception as e:
         print(f"Price check error: {e}")
 
+# ========== NOTIFICATION OUTBOX ==========
+# Triggered alerts are written to outbox.json before they leave the alert
+# store and are delivered by drain_outbox, independently of the tick.
+# Each entry is keyed by the alert id; delivered keys are remembered for
+# OUTBOX_SENT_TTL so a re-triggered alert is never sent twice.
+OUTBOX_INTERVAL = float(os.getenv("OUTBOX_INTERVAL", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_SENT_TTL = float(os.getenv("OUTBOX_SENT_TTL", str(24 * 3600)))
+# Digest keys carry their hour slot, so they only need to outlive the slot;
+# keeping them 24 h would grow outbox.json by a day of digests per user
+DIGEST_SENT_TTL = 3600
+# Telegram allows roughly 30 messages/s overall and 20/min per group or
+# channel; fan-out of a popular threshold is paced to stay under both
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "25"))
+OUTBOX_GROUP_RATE = float(os.getenv("OUTBOX_GROUP_RATE", str(20 / 60)))
+OUTBOX_GROUP_BURST = 5
+# outbox.json is rewritten after every OUTBOX_SAVE_BATCH deliveries and at
+# the end of each drain pass; a crash resends at most one batch, which is
+# what the idempotency keys are for
+OUTBOX_SAVE_BATCH = int(os.getenv("OUTBOX_SAVE_BATCH", "50"))
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    async def acquire(self):
+        delay = self.wait_time()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.wait_time()
+        self.take()
+
+SEND_BUCKET = TokenBucket(OUTBOX_RATE, max(1, OUTBOX_RATE))
+GROUP_BUCKETS = {}
+
+class Outbox:
+    def __init__(self, data):
+        self.pending = data.get("pending", {})
+        self.sent = data.get("sent", {})
+        # Set from Telegram's RetryAfter; nothing is sent before it passes
+        self.paused_until = data.get("paused_until", 0)
+        self.lock = asyncio.Lock()
+
+    def enqueue(self, key, chat_id, text):
+        if key in self.pending or key in self.sent:
+            return False
+        self.pending[key] = {
+            "chat_id": str(chat_id),
+            "text": text,
+            "created_at": time.time(),
+            "attempts": 0,
+            "next_attempt": 0
+        }
+        return True
+
+    def due(self, now):
+        return [key for key, entry in self.pending.items() if entry["next_attempt"] <= now]
+
+    def mark_sent(self, key, now):
+        self.pending.pop(key, None)
+        self.sent[key] = now
+
+    def mark_failed(self, key, now, retry_after=None):
+        entry = self.pending[key]
+        entry["attempts"] += 1
+        if entry["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            print(f"⚠️ Dropping notification {key} for {entry['chat_id']} after {entry['attempts']} attempts")
+            self.pending.pop(key)
+            return
+        delay = retry_after if retry_after is not None else min(300, 2 ** entry["attempts"])
+        entry["next_attempt"] = now + delay
+
+    def prune_sent(self, now):
+        for key in [k for k, sent_at in self.sent.items()
+                    if now - sent_at > (DIGEST_SENT_TTL if k.startswith("digest:") else OUTBOX_SENT_TTL)]:
+            del self.sent[key]
+
+    def save(self):
+        save_outbox({"pending": self.pending, "sent": self.sent, "paused_until": self.paused_until})
+
+OUTBOX = Outbox(load_outbox())
+
+async def drain_outbox(context: ContextTypes.DEFAULT_TYPE):
+    if OUTBOX.lock.locked() or time.time() < OUTBOX.paused_until:
+        return
+    async with OUTBOX.lock:
+        now = time.time()
+        OUTBOX.prune_sent(now)
+        unsaved = 0
+        try:
+            for key in OUTBOX.due(now):
+                entry = OUTBOX.pending.get(key)
+                if entry is None:
+                    continue
+                chat_id = int(entry["chat_id"])
+                if chat_id < 0:
+                    # Groups and channels have ids below zero; when one is over
+                    # its own limit, leave its messages for a later drain
+                    bucket = GROUP_BUCKETS.setdefault(chat_id, TokenBucket(OUTBOX_GROUP_RATE, OUTBOX_GROUP_BURST))
+                    if bucket.wait_time() > 0:
+                        continue
+                    bucket.take()
+                await SEND_BUCKET.acquire()
+                unsaved += 1
+                try:
+                    await context.bot.send_message(chat_id=chat_id, text=entry["text"])
+                except RetryAfter as e:
+                    # Flood control applies to the whole bot: pause every drain
+                    # until it lifts. The entry stays due and isn't charged an
+                    # attempt, since it did nothing wrong.
+                    OUTBOX.paused_until = time.time() + e.retry_after
+                    print(f"⏸️ Flood control: pausing notifications for {e.retry_after}s")
+                    break
+                except Forbidden as e:
+                    # The user blocked the bot: nothing we send will arrive
+                    print(f"Dropping notification for {entry['chat_id']}: {e}")
+                    OUTBOX.pending.pop(key, None)
+                    async with ALERTS_LOCK:
+                        pruned = prune_user_alerts(entry["chat_id"])
+                    if pruned:
+                        print(f"🧹 Pruned {pruned} alert(s) of blocked chat {entry['chat_id']}")
+                except BadRequest as e:
+                    print(f"Dropping notification for {entry['chat_id']}: {e}")
+                    OUTBOX.pending.pop(key, None)
+                except Exception as e:
+                    print(f"Failed to notify user {entry['chat_id']}: {e}")
+                    OUTBOX.mark_failed(key, time.time())
+                else:
+                    OUTBOX.mark_sent(key, time.time())
+                if unsaved >= OUTBOX_SAVE_BATCH:
+                    OUTBOX.save()
+                    unsaved = 0
+        finally:
+            if unsaved:
+                OUTBOX.save()
+
+# ========== ALERT COMPACTION ==========
+# Drops expired alerts and alerts whose owner lost access, so the tick
+# only evaluates live demand.
+COMPACTION_INTERVAL = int(os.getenv("COMPACTION_INTERVAL", "600"))
+
+def alert_owner_ids(access):
+    return set(access["users"]) | set(access.get("channels", {})) | {access["owner"]}
+
+def compact_alerts(alerts, access, now=None):
+    now = now or time.time()
+    allowed = alert_owner_ids(access)
+    expired = orphaned = 0
+    for user_id in list(alerts):
+        if user_id not in allowed:
+            orphaned += len(alerts.pop(user_id))
+            continue
+        live = [alert for alert in alerts[user_id] if not is_alert_expired(alert, now)]
+        expired += len(alerts[user_id]) - len(live)
+        if live:
+            alerts[user_id] = live
+        else:
+            del alerts[user_id]
+    return expired, orphaned
+
+async def compact_alert_store(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        async with ALERTS_LOCK:
+            alerts = load_alerts()
+            if not alerts:
+                return
+            expired, orphaned = compact_alerts(alerts, load_access())
+            if expired or orphaned:
+                save_alerts(alerts)
+        if expired or orphaned:
+            print(f"🧹 Compacted alerts: {expired} expired, {orphaned} from removed users")
+    except Exception as e:
+        print(f"Alert compaction error: {e}")
+
 # ========== SELF-PINGING ==========
 async def ping_self():
     while True:
@@ -1029,7 +3241,229 @@ async def ping_self():
             print(f"⚠️ Ping failed: {str(e)}")
         await asyncio.sleep(300)
 
+# ========== WARM RESTART ==========
+# On shutdown (SIGTERM stops run_polling, which calls post_stop) the last
+# known prices, the job schedule and the queued owner digest are written
+# to runtime.json (or Firestore). On start they are restored before
+# polling begins, so /price answers from the restored cache right away
+# while warm_up refreshes it in the background. The owner's "started"
+# message is sent once that refresh is done. Pending notifications are
+# already durable in the outbox (outbox.json, or Firestore next to the
+# snapshot).
+RUNTIME_MAX_AGE = float(os.getenv("RUNTIME_MAX_AGE", "3600"))
+JOB_LAST_RUN = {}
+
+def scheduled(name, callback):
+    timed_callback = timed(name, callback)
+
+    @functools.wraps(callback)
+    async def wrapper(context):
+        JOB_LAST_RUN[name] = time.time()
+        return await timed_callback(context)
+    return wrapper
+
+def first_run_delay(name, interval, cold_first):
+    # Keep the previous instance's cadence; anything overdue runs now
+    last = JOB_LAST_RUN.get(name)
+    if last is None:
+        return cold_first
+    return min(interval, max(0, last + interval - time.time()))
+
+def runtime_snapshot():
+    return {
+        "saved_at": time.time(),
+        "last_prices": {
+            coin: {cur: list(quote) for cur, quote in quoted.items()}
+            for coin, quoted in UPSTREAM.last_prices.items()
+        },
+        "job_last_run": dict(JOB_LAST_RUN),
+        "owner_digest": list(OWNER_DIGEST),
+        "digest_prices": DIGEST_PRICES
+    }
+
+def save_runtime_snapshot():
+    data = runtime_snapshot()
+    try:
+        if STORE is not None:
+            STORE.save_runtime(data)
+        else:
+            write_json_atomic(RUNTIME_FILE, data)
+        print(f"💾 Saved runtime snapshot ({len(data['last_prices'])} coins)")
+    except Exception as e:
+        print(f"Error saving runtime snapshot: {e}")
+
+def load_runtime_snapshot():
+    try:
+        if STORE is not None:
+            return STORE.load_runtime()
+        if os.path.exists(RUNTIME_FILE):
+            with open(RUNTIME_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"Error loading runtime snapshot: {e}")
+    return None
+
+def restore_runtime_state():
+    global OUTBOX
+    # The previous instance flushed its outbox while shutting down
+    OUTBOX = Outbox(load_outbox())
+
+    snapshot = load_runtime_snapshot()
+    if not snapshot:
+        return None
+    age = time.time() - snapshot.get("saved_at", 0)
+    UPSTREAM.restore(snapshot.get("last_prices", {}))
+    UPSTREAM.warming = age <= RUNTIME_MAX_AGE and bool(UPSTREAM.last_prices)
+    JOB_LAST_RUN.update(snapshot.get("job_last_run", {}))
+    OWNER_DIGEST.extend(snapshot.get("owner_digest", []))
+    for interval, prices in snapshot.get("digest_prices", {}).items():
+        if interval in DIGEST_PRICES:
+            DIGEST_PRICES[interval].update(prices)
+    print(f"♻️ Restored runtime snapshot from {format_age(snapshot.get('saved_at', 0))} ago ({len(UPSTREAM.last_prices)} coins)")
+    return snapshot
+
+async def warm_up(app, snapshot):
+    start = time.perf_counter()
+    # Building the index now also saves the first tick from doing it
+    index = get_alert_index(load_alerts(readonly=True))
+    coins = index.coins() | set(UPSTREAM.last_prices)
+    currencies = index.currencies() | {cur for quoted in UPSTREAM.last_prices.values() for cur in quoted} | {"usd"}
+    fresh = 0
+    try:
+        if coins:
+            prices, stale = await UPSTREAM.fetch_prices(coins, currencies)
+            fresh = len(prices) - len(stale)
+    except Exception as e:
+        print(f"Warm-up refresh failed: {e}")
+    finally:
+        UPSTREAM.warming = False
+
+    text = "🤖 Bot started successfully!"
+    if snapshot:
+        text += (
+            f"\n\n♻️ Warm start from a snapshot {format_age(snapshot.get('saved_at', 0))} old"
+            f"\nPrices refreshed: {fresh}/{len(coins)} coins in {time.perf_counter() - start:.1f}s"
+            f"\nPending notifications: {len(OUTBOX.pending)}"
+        )
+    try:
+        await app.bot.send_message(chat_id=OWNER_ID, text=text)
+    except Exception as e:
+        print(f"Owner notification failed: {e}")
+
+async def persist_runtime_state(app):
+    OUTBOX.save()
+    save_runtime_snapshot()
+    if STORE is not None:
+        await asyncio.to_thread(STORE.flush)
+
 # ========== MAIN APPLICATION ==========
+COMMANDS = [
+    ("start", start),
+    ("help", help_command),
+    ("request", request_access),
+    ("approve", approve_user),
+    ("decline", decline_user),
+    ("new_coin", new_coin),
+    ("request_coin", request_coin_access),
+    ("approve_coin", approve_coin),
+    ("decline_coin", decline_coin),
+    ("list_users", list_users),
+    ("add", add_alert),
+    ("list", list_alerts),
+    ("remove", remove_alert),
+    ("coin", coin_command),
+    ("price", get_price),
+    ("remove_user", remove_user),
+    ("remove_coin", remove_coin),
+    ("export", export_data),
+    ("import", import_help),
+    ("stats", stats_command),
+    ("lag", lag_command),
+    ("mem", mem_command),
+    ("search", search_command),
+    ("digest", digest_command),
+    ("channel_add", channel_add),
+    ("channel_remove", channel_remove),
+    ("channel_alert", channel_alert),
+    ("channels", list_channels)
+]
+
+# Updates run concurrently on UPDATE_WORKERS slots (the processor's own
+# semaphore). Updates from the same user run in the order they were sent:
+# while one of a user's updates is running, later ones are handed to it and
+# run after it on the same slot, so a user's queued commands never hold
+# slots other users could be running in. PTB's update fetcher starts a task
+# per update regardless, so this bounds concurrency, not intake.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, workers=UPDATE_WORKERS):
+        super().__init__(workers)
+        self.user_queues = {}
+
+    @staticmethod
+    def ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.ordering_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        queue = self.user_queues.get(key)
+        if queue is not None:
+            # The user's previous update is still running; it picks this one
+            # up next, and this call gives its slot back right away
+            queue.append(coroutine)
+            return
+
+        queue = self.user_queues[key] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue.popleft()
+                except Exception as e:
+                    print(f"Update handling error: {e}")
+        finally:
+            del self.user_queues[key]
+            for pending in queue:
+                pending.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+TICK = TickScheduler("check_prices", check_prices)
+
+# name, callback, interval, first run on a cold start
+JOBS = [
+    ("drain_outbox", drain_outbox, OUTBOX_INTERVAL, 1),
+    ("compact_alerts", compact_alert_store, COMPACTION_INTERVAL, 60),
+    ("request_digest", send_request_digest, REQUEST_DIGEST_INTERVAL, REQUEST_DIGEST_INTERVAL),
+]
+
+def build_application(token=BOT_TOKEN, base_url=None, workers=UPDATE_WORKERS):
+    # base_url lets tools such as loadtest.py point the bot at a fake Bot API
+    builder = ApplicationBuilder().token(token).concurrent_updates(UserOrderedUpdateProcessor(workers))
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
+
+    for cmd, handler in COMMANDS:
+        app.add_handler(CommandHandler(cmd, timed(cmd, handler)))
+
+    app.add_handler(MessageHandler(filters.Document.ALL, timed("import_document", import_document)))
+    app.add_handler(MessageHandler(filters.COMMAND, unknown_command))
+    return app
+
 async def main():
     # Clean up previous instances
     kill_previous_instances()
@@ -1039,43 +3473,25 @@ async def main():
     run_ping_server()
     
     try:
-        app = ApplicationBuilder().token(BOT_TOKEN).build()
-        
-        # Add command handlers
-        commands = [
-            ("start", start),
-            ("help", help_command),
-            ("request", request_access),
-            ("approve", approve_user),
-            ("decline", decline_user),
-            ("new_coin", new_coin),
-            ("request_coin", request_coin_access),
-            ("approve_coin", approve_coin),
-            ("decline_coin", decline_coin),
-            ("list_users", list_users),
-            ("add", add_alert),
-            ("list", list_alerts),
-            ("remove", remove_alert),
-            ("coin", coin_command),
-            ("price", get_price),
-            ("remove_user", remove_user),
-            ("remove_coin", remove_coin)
-        ]
-        
-        for cmd, handler in commands:
-            app.add_handler(CommandHandler(cmd, handler))
-        
-        app.add_handler(MessageHandler(filters.COMMAND, unknown_command))
+        app = build_application()
+        snapshot = restore_runtime_state()
+        app.post_stop = persist_runtime_state
         
         # Start jobs
-        app.job_queue.run_repeating(check_prices, interval=15, first=5)
+        for name, callback, interval, first in JOBS:
+            app.job_queue.run_repeating(scheduled(name, callback), interval=interval, first=first_run_delay(name, interval, first), name=name)
+        # The price digest stays on the hour instead of resuming the old cadence
+        missed = missed_digest_slots(JOB_LAST_RUN.get("price_digest"))
+        app.job_queue.run_repeating(scheduled("price_digest", send_digests), interval=3600, first=seconds_until_next_hour(), name="price_digest")
+        if missed:
+            app.job_queue.run_once(scheduled("price_digest", catch_up_digests), 1, data=missed, name="price_digest_catch_up")
+        asyncio.create_task(TICK.run(app, first_run_delay(TICK.name, TICK.interval, 5)))
         asyncio.create_task(ping_self())
-        
-        # Notify owner bot started
-        try:
-            await app.bot.send_message(chat_id=OWNER_ID, text="🤖 Bot started successfully!")
-        except Exception as e:
-            print(f"Owner notification failed: {e}")
+        asyncio.create_task(LOOP_MONITOR.run())
+        MEMORY.loop = asyncio.get_running_loop()
+        asyncio.create_task(refresh_coin_catalog())
+        # Notifies the owner once prices are refreshed
+        asyncio.create_task(warm_up(app, snapshot))
         
         print("✅ Bot is running...")
         await app.run_polling()  # runs forever until interrupted
@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from collections import deque
+
+from aiohttp import web
+
+import bot
+
+# ========== LOAD TEST ==========
+# Runs the real Application against a local fake Telegram Bot API (and a
+# fake CoinGecko), injects commands from simulated users and measures the
+# time from injecting an update to the bot's first reply in that chat.
+# Everything runs on 127.0.0.1; no network access is needed.
+#
+#   python loadtest.py --users 2000 --updates 20000 --rate 500 \
+#       --mix price=40,add=20,list=20,remove=10,list_users=5,stats=5
+#
+# --api-latency adds a delay to every sendMessage, which is where
+# --workers (concurrent update handling) makes the difference.
+
+FAKE_TOKEN = "123456:LOADTEST"
+OWNER_COMMANDS = {"list_users", "stats", "lag", "export", "approve", "decline"}
+DEFAULT_MIX = "price=40,add=20,list=20,remove=10,list_users=5,stats=5"
+# Outbox messages (alert notifications, digests) aren't answers to an
+# injected command, so they must not be matched against one
+NOTIFICATION_PREFIXES = ("🚨",) + tuple(f"📰 {interval.capitalize()} price digest" for interval in bot.DIGEST_INTERVALS)
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip().lstrip("/")] = float(weight or 1)
+    return mix
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+class FakeTelegram:
+    def __init__(self, api_latency=0):
+        self.api_latency = api_latency
+        self.updates = deque()
+        self.update_event = asyncio.Event()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        # chat_id -> deque of (command, injected_at) still waiting for a reply
+        self.waiting = {}
+        self.latencies = {}
+        self.injected = {}
+        self.outstanding = 0
+        self.notifications = 0
+
+    # ----- Bot API side -----
+    async def handle_bot_api(self, request):
+        method = request.match_info["method"].lower()
+        params = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        elif request.can_read_body:
+            params.update({k: v for k, v in (await request.post()).items() if isinstance(v, str)})
+
+        handler = getattr(self, f"api_{method}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def api_getme(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    async def api_getupdates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self.update_event.clear()
+            try:
+                await asyncio.wait_for(self.update_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [self.updates[i] for i in range(min(limit, len(self.updates)))]
+
+    async def api_sendmessage(self, params):
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        text = params.get("text", "")
+        if text.startswith(NOTIFICATION_PREFIXES):
+            self.notifications += 1
+            return self._message(params, {"text": text})
+        return self._reply(params, {"text": text})
+
+    async def api_senddocument(self, params):
+        return self._reply(params, {"document": {"file_id": "doc", "file_unique_id": "doc"}})
+
+    def _reply(self, params, content):
+        chat_id = int(params["chat_id"])
+        waiting = self.waiting.get(chat_id)
+        if waiting:
+            command, injected_at = waiting.popleft()
+            self.latencies.setdefault(command, []).append(time.perf_counter() - injected_at)
+            self.outstanding -= 1
+        return self._message(params, content)
+
+    def _message(self, params, content):
+        chat_id = int(params["chat_id"])
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **content}
+
+    # ----- CoinGecko side -----
+    async def handle_simple_price(self, request):
+        ids = request.query.get("ids", "").split(",")
+        currencies = request.query.get("vs_currencies", "usd").split(",")
+        return web.json_response({
+            coin: {cur: round(random.uniform(0.5, 100000), 5) for cur in currencies}
+            for coin in ids if coin
+        })
+
+    async def handle_coins_list(self, request):
+        return web.json_response([{"id": coin, "symbol": symbol, "name": coin} for symbol, coin in bot.SYMBOL_MAP.items()])
+
+    # ----- Injection -----
+    def inject(self, user_id, command, text):
+        update_id = self.next_update_id
+        self.next_update_id += 1
+        command_length = len(text.split()[0])
+        self.updates.append({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": command_length}]
+            }
+        })
+        self.waiting.setdefault(user_id, deque()).append((command, time.perf_counter()))
+        self.injected[command] = self.injected.get(command, 0) + 1
+        self.outstanding += 1
+        self.update_event.set()
+
+def command_text(command, symbols, target_id):
+    if command == "price":
+        return f"/price {' '.join(random.sample(symbols, min(2, len(symbols))))}"
+    if command == "add":
+        return f"/add {random.choice(symbols)} {random.randint(1, 200000)} {random.choice(['above', 'below'])}"
+    if command == "remove":
+        return "/remove 1"
+    if command in ("approve", "decline"):
+        return f"/{command} {target_id}"
+    if command == "export":
+        return "/export alerts"
+    return f"/{command}"
+
+def seed_data_dir(path, owner_id, user_ids):
+    # Point the bot's JSON stores at a scratch directory
+    bot.ALERT_FILE = os.path.join(path, "prices.json")
+    bot.ACCESS_FILE = os.path.join(path, "access.json")
+    bot.SYMBOL_MAP_FILE = os.path.join(path, "symbols.json")
+    bot.OUTBOX_FILE = os.path.join(path, "outbox.json")
+    bot.OUTBOX = bot.Outbox({})
+    coins = list(bot.SYMBOL_MAP)
+    bot.save_symbol_map(bot.SYMBOL_MAP)
+    bot.save_alerts({})
+    bot.save_access({
+        "owner": str(owner_id),
+        "users": {str(uid): {"coins": coins, "username": f"user{uid}"} for uid in user_ids},
+        "requests": {},
+        "coin_requests": {}
+    })
+
+async def run_load(args):
+    fake = FakeTelegram(args.api_latency / 1000)
+    web_app = web.Application()
+    web_app.router.add_route("*", "/bot{token}/{method}", fake.handle_bot_api)
+    web_app.router.add_get("/api/v3/simple/price", fake.handle_simple_price)
+    web_app.router.add_get("/api/v3/coins/list", fake.handle_coins_list)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+    base = f"http://127.0.0.1:{args.port}"
+
+    owner_id = 1000
+    user_ids = list(range(owner_id + 1, owner_id + 1 + args.users))
+    mix = parse_mix(args.mix)
+    commands, weights = list(mix), list(mix.values())
+    symbols = list(bot.SYMBOL_MAP)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        seed_data_dir(data_dir, owner_id, user_ids)
+        bot.UPSTREAM = bot.UpstreamClient(f"{base}/api/v3")
+
+        app = bot.build_application(token=FAKE_TOKEN, base_url=f"{base}/bot", workers=args.workers)
+
+        async with app:
+            await app.start()
+            await app.updater.start_polling(poll_interval=0.0, timeout=1)
+            if args.with_tick:
+                tick = bot.TickScheduler("check_prices", bot.check_prices, args.tick_interval)
+                tick_task = asyncio.create_task(tick.run(app, first=1))
+
+            print(f"🚀 Injecting {args.updates} updates from {args.users} users...")
+            start = time.perf_counter()
+            for n in range(args.updates):
+                command = random.choices(commands, weights)[0]
+                user_id = owner_id if command in OWNER_COMMANDS else random.choice(user_ids)
+                fake.inject(user_id, command, command_text(command, symbols, random.choice(user_ids)))
+                if args.rate:
+                    delay = start + (n + 1) / args.rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif n % 100 == 0:
+                    await asyncio.sleep(0)
+
+            deadline = time.monotonic() + args.drain_timeout
+            while fake.outstanding > 0 and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - start
+
+            if args.with_tick:
+                tick_task.cancel()
+            await app.updater.stop()
+            await app.stop()
+
+    await runner.cleanup()
+    return fake, elapsed
+
+def report(fake, elapsed):
+    replied = sum(len(samples) for samples in fake.latencies.values())
+    print(f"\n{'command':<14}{'sent':>8}{'replied':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for command in sorted(fake.injected):
+        ordered = sorted(fake.latencies.get(command, []))
+        cells = [percentile(ordered, p) for p in (50, 95, 99)]
+        cells = ["-" if c is None else f"{c * 1000:.1f}" for c in cells]
+        print(f"{command:<14}{fake.injected[command]:>8}{len(ordered):>9}{cells[0]:>10}{cells[1]:>10}{cells[2]:>10}")
+    print(f"\n⚡ {replied} replies in {elapsed:.2f}s ({replied / max(elapsed, 1e-9):,.0f} commands/s)")
+    if fake.notifications:
+        print(f"🔔 {fake.notifications} alert notification(s) delivered (not counted as replies)")
+    if fake.outstanding:
+        print(f"⚠️ {fake.outstanding} update(s) got no reply before the drain timeout")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end load test against a fake Telegram Bot API.")
+    parser.add_argument("--users", type=int, default=1000, help="number of simulated approved users")
+    parser.add_argument("--updates", type=int, default=5000, help="total commands to inject")
+    parser.add_argument("--rate", type=float, default=0, help="commands per second (0 = as fast as possible)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted command mix, e.g. price=40,add=20")
+    parser.add_argument("--port", type=int, default=18081, help="port for the fake Bot API and CoinGecko")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for outstanding replies")
+    parser.add_argument("--workers", type=int, default=bot.UPDATE_WORKERS, help="updates handled concurrently by the bot")
+    parser.add_argument("--api-latency", type=float, default=0, help="simulated sendMessage round trip in ms")
+    parser.add_argument("--with-tick", action="store_true", help="also run the check_prices job during the test")
+    parser.add_argument("--tick-interval", type=float, default=15, help="check_prices interval with --with-tick")
+    parser.add_argument("--seed", type=int, help="random seed for a reproducible command stream")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    fake, elapsed = asyncio.run(run_load(args))
+    report(fake, elapsed)
+
+
+if __name__ == "__main__":
+    main()